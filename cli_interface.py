@@ -30,6 +30,9 @@ class Interface(object):
         list_of_entities = self.ers.search(prop,val)
         return list_of_entities
 
+    def iter_search_for_entity(self, prop, val=None):
+        return self.ers.iter_search(prop, val)
+
     def show_peers(self):
         list_of_peers = self.ers.get_peers()
         return list_of_peers
@@ -92,19 +95,13 @@ class Interface(object):
         print table
 
     def import_entity(self, entity_uri):
-        entities = {}
-
         # Load
         g = Graph()
         g.parse(entity_uri)
+        entities = self.ers.get_many(set(g.subjects()))
         for statement in g:
             (s, p, o) = statement
-            if s not in entities:
-                entity = self.ers.get(s)
-                entities[s] = entity
-            else:
-                entity = entities[s]
-            entity.add(p, o)
+            entities[unicode(s)].add(p, o)
         for entity in entities.itervalues():
             self.ers.persist_entity(entity)
 
@@ -7,14 +7,19 @@ Provides class ERS implementing API to Entity Registry System.
 import sys
 import os
 import signal
+import time
 
 from hashlib import md5
+from itertools import islice
+from uuid import uuid4
 from socket import gethostname
-from collections import Counter
-from random import randrange
+import concurrent.futures
 
 import store
-from timeout import TimeoutError
+import lru
+import writebuffer
+from notifier import ReplicationNotifier, DEFAULT_WINDOW
+from health import PeerHealth
 
 import binascii
 import dbus
@@ -22,6 +27,20 @@ from ers.store import OWN_DBS, ERS_PUBLIC_DB, ERS_PRIVATE_DB, ERS_CACHE_DB, ERS_
 import requests
 from daemon import FLASK_PORT
 
+# Maximum number of remote peers queried at the same time
+REMOTE_QUERY_WORKERS = 8
+# Time budget (in seconds) for collecting the answers of all the peers
+REMOTE_QUERY_DEADLINE = 1.0
+# Maximum number of entities fetched with one multi-key request by get_many
+GET_MANY_CHUNK_SIZE = 500
+# Number of entities written with one _bulk_docs request by persist_entities
+PERSIST_CHUNK_SIZE = 500
+# Minimum time (in seconds) between two checks of the peer list kept in ers-state
+PEERS_REFRESH_INTERVAL = 5.0
+
+# Shared by all the ERS instances of the process to keep the number of threads bounded
+_peer_pool = concurrent.futures.ThreadPoolExecutor(max_workers=REMOTE_QUERY_WORKERS)
+
 class ERSReadOnly(object):
     """ ERS version with read-only methods.
 
@@ -29,12 +48,53 @@ class ERSReadOnly(object):
         :type fixed_peers: list
         :param local_only: whether or not the peer is local-only
         :type local_only: bool.
+        :param remote_deadline: seconds to wait for the answers of remote peers
+        :type remote_deadline: float.
+        :param peers_refresh_interval: seconds during which the peer list is
+            used without checking ers-state for changes
+        :type peers_refresh_interval: float.
+        :param entity_cache_size: number of entities whose local documents are
+            kept in memory between reads (0 disables the cache)
+        :type entity_cache_size: int.
+        :param entity_cache_bytes: approximate memory limit of that cache
+        :type entity_cache_bytes: int.
+        :param index_backend: indexes used by the local store, 'javascript',
+            'erlang' or 'mango' (see ers.store), None for those the daemon set
+            up from its configuration
+        :type index_backend: str.
+        :param stale: freshness of the local index reads, None to wait for the
+            indexes to include the latest writes, 'ok' or 'update_after' to read
+            them as they are (kept up to date by the daemon's index warmer)
+        :type stale: str.
+        :param storage: storage engine of the local store, 'couchdb' or
+            'sqlite' (ers.sqlitestore, for local-only nodes without CouchDB)
+        :type storage: str.
+        :param storage_path: directory of the SQLite files
+        :type storage_path: str.
     """
-    def __init__(self, fixed_peers=(), local_only=False):
+    def __init__(self, fixed_peers=(), local_only=False, remote_deadline=REMOTE_QUERY_DEADLINE,
+                 peers_refresh_interval=PEERS_REFRESH_INTERVAL,
+                 entity_cache_size=0, entity_cache_bytes=lru.DEFAULT_MAX_BYTES,
+                 index_backend=None, stale=None,
+                 storage=store.STORAGE_COUCHDB, storage_path=None):
         self._local_only = local_only
         self.fixed_peers = [] if self._local_only else list(fixed_peers)
-        self._timeout_count = Counter()
-        self.store = store.Store()
+        self.remote_deadline = remote_deadline
+        self.peers_refresh_interval = peers_refresh_interval
+        self._peers = None
+        self._peers_rev = None
+        self._peers_checked_at = 0
+        self.entity_cache = None
+        if entity_cache_size > 0:
+            self.entity_cache = lru.EntityLRU(entity_cache_size, entity_cache_bytes)
+        self.peer_health = PeerHealth(slow_threshold=remote_deadline)
+        # Needed to open the same local store in other processes (import workers)
+        self.store_options = {'storage': storage, 'storage_path': storage_path,
+                              'index_backend': index_backend, 'stale': stale}
+        if storage == store.STORAGE_SQLITE:
+            self.store = store.create_store(storage, storage_path)
+        else:
+            self.store = store.create_store(storage, index_backend=index_backend, stale=stale)
         self._init_host_urn()
         self.peer_type = None
 
@@ -58,12 +118,12 @@ class ERSReadOnly(object):
         '''
         return self.host_urn
 
-    def _is_failing(self, url):
-        """
-        Returns True for url's which failed to respond with increasing probability.
-        Returns False for url's which did not fail.
+    def get_peer_health(self):
+        """ Get the latency, error rate and circuit state of the known peers.
+
+            :rtype: dict
         """
-        return randrange(self._timeout_count[url] + 1) != 0
+        return self.peer_health.state()
 
     def get(self, entity_name, include_remote = True):
         '''
@@ -74,69 +134,321 @@ class ERSReadOnly(object):
         entity = Entity(entity_name)
 
         # Add matching documents from the local store
-        for source, db_name in self.store.db_names.iteritems():
-            docs = self.store[db_name].docs_by_entity(entity_name)
+        for source, docs in self._local_docs(entity_name).iteritems():
             for doc in docs:
                 entity.add_document(doc, source)
 
         # Get documents out of public/cache of connected peers
-        # TODO parallelize
         # TODO move to a separate call
         if include_remote:
-            for peer in self.get_peers():
-                url = peer['server_url']
-                if self._is_failing(url):
-                    continue
-
-                remote_docs = []
-                try:
-                    remote_docs = store.query_remote(url, 'docs_by_entity', entity_name)
-                except TimeoutError:
-                    self._timeout_count[url] += 1
-                    sys.stderr.write("Incremented timeout count for {0}: {1}\n".format(
-                        url, self._timeout_count[url]))
-                except Exception as e:
-                    sys.stderr.write("Warning: failed to query remote peer {0}. Error: {1}\n".format(peer, e))
-                else:
-                    self._timeout_count.pop(url, 0)
-                    for doc in remote_docs:
-                        entity.add_document(doc, 'remote')
+            remote_results, slow_peers = self._query_peers('docs_by_entity', entity_name)
+            for remote_docs in remote_results.itervalues():
+                for doc in remote_docs:
+                    entity.add_document(doc, 'remote')
+            for url in slow_peers:
+                entity.add_unresponsive_peer(url)
 
         return entity
 
+    def get_many(self, entity_names, include_remote = True):
+        """ Get several entities at once.
+
+            Each local database and each peer is sent one multi-key request
+            per chunk of GET_MANY_CHUNK_SIZE entities, instead of one request
+            per entity.
+
+            :param entity_names: names of the entities to get
+            :type entity_names: iterable
+            :param include_remote: whether to add the documents held by peers
+            :type include_remote: bool
+            :returns: entities indexed by name, as unicode
+            :rtype: dict
+        """
+        entities = {}
+        for entity_name in entity_names:
+            # The rows read have unicode keys, which rdflib terms never equal
+            entity_name = unicode(store.to_unicode(entity_name))
+            if entity_name not in entities:
+                entities[entity_name] = Entity(entity_name)
+        names = entities.keys()
+
+        for i in xrange(0, len(names), GET_MANY_CHUNK_SIZE):
+            chunk = names[i:i + GET_MANY_CHUNK_SIZE]
+
+            # Add matching documents from the local store
+            for source, pairs in self.store.docs_by_entities(chunk).iteritems():
+                for entity_name, doc in pairs:
+                    entities[entity_name].add_document(doc, source)
+            for entity_name in chunk:
+                buffered = self._buffered_docs(entity_name)
+                if buffered is not None:
+                    for scope, doc in buffered.iteritems():
+                        entities[entity_name].add_document(doc, scope)
+
+            # Get documents out of public/cache of connected peers
+            if include_remote:
+                remote_results, slow_peers = self._query_peers('docs_by_entities', chunk)
+                for remote_pairs in remote_results.itervalues():
+                    for entity_name, doc in remote_pairs:
+                        entities[entity_name].add_document(doc, 'remote')
+                for url in slow_peers:
+                    for entity_name in chunk:
+                        entities[entity_name].add_unresponsive_peer(url)
+
+        return entities
+
+    def _local_docs(self, entity_name):
+        """ Get the documents of the local store describing an entity, by source.
+
+            With the entity cache enabled, only the revisions of the documents
+            are fetched when the cached copy is still current.
+        """
+        if self.entity_cache is None:
+            docs = self.store.docs_by_entity(entity_name)
+        else:
+            revisions = lru.signature(self.store.by_entity(entity_name))
+            docs = self.entity_cache.get(entity_name, revisions)
+            if docs is None:
+                docs = self.store.docs_by_entity(entity_name)
+                self.entity_cache.put(entity_name, docs)
+
+        # Pending writes replace the stored documents of their scope, as in get_many
+        buffered = self._buffered_docs(entity_name)
+        if buffered is not None:
+            docs = dict(docs)
+            for scope, doc in buffered.iteritems():
+                docs[scope] = [doc]
+        return docs
+
+    def _buffered_docs(self, entity_name):
+        """ Documents of an entity waiting to be written, by scope, None if
+            there are none. Only the read-write ERS has a write buffer.
+        """
+        return None
+
+    def _invalidate_entity(self, entity_name):
+        if self.entity_cache is not None:
+            self.entity_cache.invalidate(entity_name)
+
+    def _submit_to_peers(self, method_name, *args, **kwargs):
+        """ Start calling an ERSDatabase method on all the responsive peers,
+            fastest peers first.
+
+            :param method_name: name of the method to call on the remote database
+            :type method_name: str.
+            :returns: peer urls indexed by their pending query
+            :rtype: dict
+        """
+        futures = {}
+        urls = [peer['server_url'] for peer in self.get_peers()]
+        for url in self.peer_health.order(urls):
+            if not self.peer_health.allow(url):
+                continue
+            future = _peer_pool.submit(self._query_peer, url, method_name, *args, **kwargs)
+            futures[future] = url
+        return futures
+
+    def _query_peer(self, url, method_name, *args, **kwargs):
+        start = time.time()
+        try:
+            result = store.query_remote(url, method_name, *args, **kwargs)
+        except Exception:
+            self.peer_health.record_failure(url, time.time() - start)
+            raise
+        self.peer_health.record_success(url, time.time() - start)
+        return result
+
+    def _peer_answer(self, url, future):
+        """ Get the result of a finished remote query, None if the peer failed.
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            sys.stderr.write("Warning: failed to query remote peer {0}. Error: {1}\n".format(url, e))
+        return None
+
+    def _peer_missed_deadline(self, url, future):
+        # The query still running is accounted for by _query_peer when it ends
+        if future.cancel():
+            self.peer_health.release(url)
+        sys.stderr.write("Warning: peer {0} did not answer in time\n".format(url))
+
+    def _query_peers(self, method_name, *args, **kwargs):
+        """ Call an ERSDatabase method on all the responsive peers concurrently.
+
+            Peers which did not answer within the deadline are not waited for.
+
+            :param method_name: name of the method to call on the remote database
+            :type method_name: str.
+            :returns: results indexed by peer url and list of the urls of slow peers
+            :rtype: tuple
+        """
+        futures = self._submit_to_peers(method_name, *args, **kwargs)
+        done, not_done = concurrent.futures.wait(futures, timeout=self.remote_deadline)
+
+        results = {}
+        for future in done:
+            url = futures[future]
+            result = self._peer_answer(url, future)
+            if result is not None:
+                results[url] = result
+
+        slow_peers = []
+        for future in not_done:
+            url = futures[future]
+            self._peer_missed_deadline(url, future)
+            slow_peers.append(url)
+
+        return results, slow_peers
+
+    def _iter_peer_answers(self, futures, deadline):
+        """ Yield (url, result) pairs in the order in which the peers answer.
+
+            :param futures: peer urls indexed by their pending query
+            :type futures: dict
+            :param deadline: time after which the remaining peers are given up
+            :type deadline: float
+        """
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=max(deadline - time.time(), 0)):
+                url = futures[future]
+                result = self._peer_answer(url, future)
+                if result is not None:
+                    yield url, result
+        except concurrent.futures.TimeoutError:
+            for future, url in futures.iteritems():
+                if not future.done():
+                    self._peer_missed_deadline(url, future)
+
     def search(self, prop, value=None, include_remote = True):
         """ Search entities by property or property + value pair.
 
             :param prop: property to search for
             :type prop: str.
-            :param value: value to search for
+            :param value: value to search for, 'prefix*' matches all the values
+                starting with 'prefix'
             :type value: str.
             :returns: list of unique (entity, graph) pairs
         """
+        return list(self.iter_search(prop, value, include_remote))
+
+    def search_range(self, prop, start=None, end=None, include_remote = True):
+        """ Search entities having a value of property <prop> between <start>
+            and <end> (included, CouchDB collation order).
+
+            :returns: list of unique entity names
+        """
+        return self.search(prop, store.ValueRange(start, end), include_remote)
+
+    def iter_search(self, prop, value=None, include_remote = True):
+        """ Search entities by property or property + value pair, yielding
+            matches as they become available.
+
+            All the peers are queried at once; local matches come first, then
+            those of each peer as soon as it answers. Peers which did not
+            answer within the deadline are skipped.
+
+            :param prop: property to search for
+            :type prop: str.
+            :param value: value to search for
+            :type value: str.
+            :returns: generator of unique entity names
+        """
+        futures = {}
+        if include_remote:
+            deadline = time.time() + self.remote_deadline
+            futures = self._submit_to_peers('by_property_value', prop, value)
+
+        seen = set()
+
         # Search in the local store
-        result = set(self.store.by_property_value(prop, value))
+        for entity_name in self.store.iter_by_property_value(prop, value):
+            if entity_name not in seen:
+                seen.add(entity_name)
+                yield entity_name
+
+        # Merge in the results of the peers as they come
+        if futures:
+            for url, remote_result in self._iter_peer_answers(futures, deadline):
+                for entity_name in remote_result:
+                    if entity_name not in seen:
+                        seen.add(entity_name)
+                        yield entity_name
+
+    def search_page(self, prop, value=None, limit=store.PAGE_SIZE, cursor=None):
+        """ Get one page of the local search results for a property or
+            property + value pair.
+
+            Results are unique within a page, but an entity described in
+            several local databases can show up again on a later page.
 
-        # Search peers
+            :param prop: property to search for
+            :type prop: str.
+            :param value: value to search for
+            :type value: str.
+            :param limit: maximum number of results
+            :type limit: int.
+            :param cursor: token returned with the previous page, None for the first page
+            :type cursor: str.
+            :returns: list of entity names and token of the next page (None after the last one)
+            :rtype: tuple
+        """
+        names, next_cursor = self.store.page_by_property_value(prop, value, limit, cursor)
+        unique_names = []
+        for name in names:
+            if name not in unique_names:
+                unique_names.append(name)
+        return unique_names, next_cursor
+
+    def count(self, prop, value=None, include_remote = False):
+        """ Count the entities having a property or property + value pair
+            with the count_by_property_value index, without reading
+            the matching rows.
+
+            An entity is counted once per document giving it the property,
+            in each database holding such a document.
+
+            :param prop: property to count
+            :type prop: str.
+            :param value: value to count, 'prefix*' or a ValueRange as for search
+            :type value: str.
+            :param include_remote: add the counts of the peers answering in time
+            :type include_remote: bool.
+            :rtype: int
+        """
+        futures = {}
         if include_remote:
-            for peer in self.get_peers():
-                url = peer['server_url']
-                if self._is_failing(url):
-                    continue
-
-                remote_result = []
-                try:
-                    remote_result = store.query_remote(url, 'by_property_value', prop, value)
-                except TimeoutError:
-                    self._timeout_count[url] += 1
-                    sys.stderr.write("Incremented timeout count for {0}: {1}\n".format(
-                        url, self._timeout_count[url]))
-                except Exception as e:
-                    sys.stderr.write("Warning: failed to query remote peer {0}. Error: {1}\n".format(peer, e))
-                else:
-                    self._timeout_count.pop(url, 0)
-                    result.update(remote_result)
-
-        return list(result)
+            deadline = time.time() + self.remote_deadline
+            futures = self._submit_to_peers('count_by_property_value', prop, value)
+
+        total = self.store.count_by_property_value(prop, value)
+        if futures:
+            total += sum(result for url, result in self._iter_peer_answers(futures, deadline))
+        return total
+
+    def facets(self, prop, limit=None, include_remote = False):
+        """ Get the most frequent values of a property with their counts,
+            using one grouped reduce query per database.
+
+            :param prop: property to get the values of
+            :type prop: str.
+            :param limit: maximum number of values, None for all of them
+            :type limit: int.
+            :param include_remote: add the counts of the peers answering in time
+            :type include_remote: bool.
+            :returns: list of (value, count) pairs, most frequent first
+            :rtype: list
+        """
+        futures = {}
+        if include_remote:
+            deadline = time.time() + self.remote_deadline
+            futures = self._submit_to_peers('facets_by_property', prop)
+
+        counts = [self.store.facets_by_property(prop)]
+        if futures:
+            counts.extend(result for url, result in self._iter_peer_answers(futures, deadline))
+        facets = sorted(store.merge_counts(counts).iteritems(), key=lambda item: (-item[1], item[0]))
+        return facets if limit is None else facets[:limit]
 
     def entity_exist(self, entity_name):
         """ Check whether an entity exists in the local store.
@@ -151,19 +463,37 @@ class ERSReadOnly(object):
     def get_peers(self):
         """ Get the known peers.
 
+            The list is kept in memory and the state document of the daemon
+            is only checked for a new revision once per refresh interval.
+
             :rtype: array
         """
         if self._local_only:
             return []
 
-        result = [{'server_url': server_url} for server_url in self.fixed_peers]
+        if self._peers is None or time.time() - self._peers_checked_at >= self.peers_refresh_interval:
+            self._refresh_peers()
+        return list(self._peers)
+
+    def invalidate_peers(self):
+        """ Make the next call to get_peers() read the peer list from ers-state,
+            e.g. when the daemon signals a change.
+        """
+        self._peers_checked_at = 0
+
+    def _refresh_peers(self):
+        state_doc = self.store[ERS_STATE_DB].local_state()
+        self._peers_checked_at = time.time()
+        if self._peers is not None and state_doc.rev == self._peers_rev:
+            return
 
-        state_doc = self.store[ERS_STATE_DB]['_local/state']
+        result = [{'server_url': server_url} for server_url in self.fixed_peers]
         for peer in state_doc['peers']:
             result.append({
                 'server_url': r'http://' + peer['ip'] + ':' + str(peer['port']) + '/',
             })
-        return result
+        self._peers = result
+        self._peers_rev = state_doc.rev
 
     def is_cached(self, entity_name):
         '''
@@ -179,15 +509,52 @@ class ERS(ERSReadOnly):
         :type fixed_peers: tuple
         :param local_only: if True ERS will not attempt to connect to remote peers
         :type local_only: bool
+        :param replication_window: seconds during which replication updates
+            triggered by writes are coalesced into one request to the daemon
+        :type replication_window: float
+        :param update_replication_on_persist: whether writes to the public and
+            private stores, which do not change the replication links, also
+            trigger a replication update
+        :type update_replication_on_persist: bool
+        :param write_behind: buffer persisted entities and write them in groups
+            (see ers.writebuffer), flush() writes them immediately
+        :type write_behind: bool
+        :param write_buffer_size: number of buffered entities triggering a write
+        :type write_buffer_size: int
+        :param write_buffer_delay: maximum time in seconds an entity stays buffered
+        :type write_buffer_delay: float
+        :param durability: 'buffer' to return from persist_entity once the
+            entity is buffered, 'commit' to return once it is written
+        :type durability: str
+
+        Other keyword arguments are those of ERSReadOnly.
     """
-    def __init__(self, fixed_peers=(), local_only=False):
-        super(ERS, self).__init__(fixed_peers, local_only)
+    def __init__(self, fixed_peers=(), local_only=False, replication_window=DEFAULT_WINDOW,
+                 update_replication_on_persist=False, write_behind=False,
+                 write_buffer_size=writebuffer.DEFAULT_MAX_ENTITIES,
+                 write_buffer_delay=writebuffer.DEFAULT_MAX_DELAY,
+                 durability=writebuffer.DURABILITY_BUFFER, **kwargs):
+        super(ERS, self).__init__(fixed_peers, local_only, **kwargs)
+        self._write_buffer = None
+        if write_behind:
+            self._write_buffer = writebuffer.WriteBuffer(self._save_documents, write_buffer_size,
+                                                         write_buffer_delay, durability)
+        self.update_replication_on_persist = update_replication_on_persist
+        self._replication_notifier = ReplicationNotifier(
+            'http://localhost:'+str(FLASK_PORT)+'/ReplicationLinksUpdate', replication_window)
 
     def reset(self):
         self.store.reset()
+        if self.entity_cache is not None:
+            self.entity_cache.clear()
+        if self._write_buffer is not None:
+            self._write_buffer.clear()
 
     def trigger_replication_update(self):
-        requests.get('http://localhost:'+str(FLASK_PORT)+'/ReplicationLinksUpdate')
+        """ Ask the daemon to update the replication links, without waiting
+            for it. Requests close in time are sent as one.
+        """
+        self._replication_notifier.notify()
         return 1
 
     def delete_entity(self, entity_name):
@@ -200,34 +567,147 @@ class ERS(ERSReadOnly):
             :returns: success status
             :rtype: bool.
         """
+        return self.delete_many([entity_name])
+
+    def delete_many(self, entity_names, chunk_size=PERSIST_CHUNK_SIZE):
+        """ Delete several entities from the public and private stores.
+
+            Each store is sent one by_entity query and one _bulk_docs
+            request per chunk of <chunk_size> entities.
+
+            :param entity_names: names of the entities to delete
+            :type entity_names: iterable
+            :returns: success status, False if any document could not be deleted
+            :rtype: bool.
+        """
         status = True
-        status = status and self.store['ers-public'].delete_entity(entity_name)
-        status = status and self.store['ers-private'].delete_entity(entity_name)
+        entity_names = iter(entity_names)
+        while True:
+            chunk = list(islice(entity_names, chunk_size))
+            if not chunk:
+                break
+            for entity_name in chunk:
+                self._invalidate_entity(entity_name)
+                if self._write_buffer is not None:
+                    self._write_buffer.discard(entity_name)
+            for db_name in (ERS_PUBLIC_DB, ERS_PRIVATE_DB):
+                status = self.store[db_name].delete_entities(chunk) and status
         return status
 
     def persist_entity(self, entity):
         '''
         Persist the description of an entity in the private and public stores
         '''
-        for scope in ['public', 'private']:
-            document = entity.get_documents(scope)
+        self._invalidate_entity(entity.get_entity_name())
+        if self._write_buffer is not None:
+            self._buffer_entity(entity)
+            return
+
+        for scope, db_name in [('public', ERS_PUBLIC_DB), ('private', ERS_PRIVATE_DB)]:
+            doc = self._document_to_save(entity, scope)
 
             # Skip the document if empty or not right scope
-            if document == None:
+            if doc == None:
                 continue
 
-            doc = document.to_json()
+            # Write the document
+            self.store[db_name].save(doc)
+        if self.update_replication_on_persist:
+            self.trigger_replication_update()
 
-            # Update the author, last modif date and other meta-data
-            if '@owner' not in doc:
-                doc['@owner'] = self.host_urn
+    def persist_entities(self, entities, chunk_size=PERSIST_CHUNK_SIZE):
+        '''
+        Persist the descriptions of many entities, with one _bulk_docs
+        request per store and per chunk of <chunk_size> entities. The
+        entities are consumed lazily from the iterable.
+        @param entities An iterable of entity objects
+        @return list of (entity_name, scope, success, doc_id, rev) tuples,
+        where rev is the exception (e.g. ResourceConflict) on failure
+        '''
+        results = []
+        entities = iter(entities)
+        while True:
+            chunk = list(islice(entities, chunk_size))
+            if not chunk:
+                break
+
+            items = []
+            for entity in chunk:
+                self._invalidate_entity(entity.get_entity_name())
+                # Written now, an older buffered copy must not be written after it
+                if self._write_buffer is not None:
+                    self._write_buffer.discard(entity.get_entity_name())
+                for scope in ['public', 'private']:
+                    doc = self._document_to_save(entity, scope)
+                    if doc != None:
+                        items.append((entity.get_entity_name(), scope, doc))
+            results.extend(self._save_documents(items))
+
+            if self.update_replication_on_persist:
+                self.trigger_replication_update()
+        return results
 
-            # Write the document
-            if scope == 'public':
-                self.store[ERS_PUBLIC_DB].save(doc)
-            elif scope == 'private':
-                self.store[ERS_PRIVATE_DB].save(doc)
-        self.trigger_replication_update()
+    def _save_documents(self, items):
+        '''
+        Write documents with one _bulk_docs request per store. Saved
+        documents get their new _id and _rev set in place.
+        @param items list of (entity_name, scope, doc) tuples
+        @return list of (entity_name, scope, success, doc_id, rev) tuples
+        '''
+        pending = {ERS_PUBLIC_DB: [], ERS_PRIVATE_DB: []}
+        for item in items:
+            pending[ERS_PUBLIC_DB if item[1] == 'public' else ERS_PRIVATE_DB].append(item)
+
+        results = []
+        for db_name, db_items in pending.iteritems():
+            if not db_items:
+                continue
+            statuses = self.store[db_name].update([doc for _, _, doc in db_items])
+            for (entity_name, scope, _), (success, doc_id, rev) in zip(db_items, statuses):
+                results.append((entity_name, scope, success, doc_id, rev))
+        return results
+
+    def _buffer_entity(self, entity):
+        docs = {}
+        for scope in ['public', 'private']:
+            doc = self._document_to_save(entity, scope)
+            if doc != None:
+                # Later writes of this entity must update the same document
+                if '_id' not in doc:
+                    doc['_id'] = uuid4().hex
+                docs[scope] = doc
+        if docs:
+            self._write_buffer.add(entity.get_entity_name(), docs)
+
+    def flush(self):
+        '''
+        Write the entities held in the write-behind buffer now
+        @return list of (entity_name, scope, success, doc_id, rev) tuples
+        '''
+        if self._write_buffer is None:
+            return []
+        return self._write_buffer.flush()
+
+    def _buffered_docs(self, entity_name):
+        if self._write_buffer is None:
+            return None
+        return self._write_buffer.get(entity_name)
+
+    def _document_to_save(self, entity, scope):
+        '''
+        Get the JSON of the <scope> document of an entity, ready to be saved
+        @return the document or None if the entity has no such document
+        '''
+        document = entity.get_documents(scope)
+        if document == None:
+            return None
+
+        doc = document.to_json()
+
+        # Update the author, last modif date and other meta-data
+        if '@owner' not in doc:
+            doc['@owner'] = self.host_urn
+        return doc
 
     def cache_entity(self, entity):
         '''
@@ -237,16 +717,32 @@ class ERS(ERSReadOnly):
         this entity with new / updated documents
         @param entity An entity object
         '''
-        # No point in caching it again
-        #if self.is_cached(entity.get_entity_name()):
-        #    return
-
-        # Save all its current documents in the cache
-        for document in entity.get_documents('remote'):
-
-            self.store[ERS_CACHE_DB].save(document.to_json())
+        self.cache_entities([entity])
 
-        self.trigger_replication_update()
+    def cache_entities(self, entities, chunk_size=PERSIST_CHUNK_SIZE):
+        '''
+        Place several entities in the cache, e.g. the results of a search.
+        The remote documents are written with one _revs_diff and one
+        _bulk_docs request per chunk of <chunk_size> entities, keeping their
+        revisions; documents the cache already holds are skipped.
+        @param entities An iterable of entity objects
+        @return number of documents written to the cache
+        '''
+        written = 0
+        entities = iter(entities)
+        while True:
+            chunk = list(islice(entities, chunk_size))
+            if not chunk:
+                break
+            docs = []
+            for entity in chunk:
+                self._invalidate_entity(entity.get_entity_name())
+                docs.extend(document.to_json() for document in entity.get_documents('remote'))
+            written += self.store[ERS_CACHE_DB].save_replicas(docs)
+
+        if written > 0:
+            self.trigger_replication_update()
+        return written
 
     def delete_from_cache(self, entity_name):
         """ Delete an entity from the cache.
@@ -256,6 +752,7 @@ class ERS(ERSReadOnly):
             :returns: success status
             :rtype: bool
         """
+        self._invalidate_entity(entity_name)
         return self.store[ERS_CACHE_DB].delete_entity(entity_name)
 
 class Document():
@@ -394,6 +891,9 @@ class Entity():
             'cache' : []
         }
 
+        # Peers which did not answer in time when the entity was loaded
+        self._unresponsive_peers = []
+
     def add(self, predicate, value, private=False):
         '''
         Add a property to the description of the entity
@@ -466,6 +966,20 @@ class Entity():
         '''
         return self._documents[scope]
 
+    def add_unresponsive_peer(self, peer_url):
+        '''
+        Record a peer whose documents could not be collected in time
+        '''
+        self._unresponsive_peers.append(peer_url)
+
+    def get_unresponsive_peers(self):
+        '''
+        Get the peers which did not answer in time, the documents they
+        hold about the entity are missing from the description
+        @return list of peer urls
+        '''
+        return self._unresponsive_peers
+
     def get_entity_name(self):
         '''
         Get the name of the entity
@@ -29,7 +29,8 @@ from defaults import ERS_AVAHI_SERVICE_TYPE, ERS_PEER_TYPE_BRIDGE, ERS_PEER_TYPE
 from defaults import set_logging
 import gobject
 from zeroconf import ERSPeerInfo
-from store import ERS_PUBLIC_DB, ERS_CACHE_DB, ERS_STATE_DB
+from store import ERS_PUBLIC_DB, ERS_CACHE_DB, ERS_STATE_DB, INDEX_JAVASCRIPT, ALL_DBS
+from warmer import IndexWarmer
 
 import requests
 from flask import Flask, request
@@ -94,6 +95,16 @@ class Configuration(object):
     def node_type(self):
         return self._config.get('node','type')
 
+    def index_backend(self):
+        if not self._config.has_option('couchdb', 'index'):
+            return INDEX_JAVASCRIPT
+        return self._config.get('couchdb', 'index')
+
+    def warm_indexes(self):
+        if not self._config.has_option('couchdb', 'warm_indexes'):
+            return True
+        return self._config.getboolean('couchdb', 'warm_indexes')
+
 class ERSDaemon(object):
     """
         The daemon class for the ERS daemon.
@@ -106,11 +117,14 @@ class ERSDaemon(object):
     prefix = None
     pidfile = None
     tries = None
+    index_backend = None
+    warm_indexes = None
     logger = None
 
     _active = False
     _service = None
     _monitor = None
+    _warmer = None
     #this maintains some basic state.
     #we don't want to do too many updates to the replicator database
     #because it might stop current replications
@@ -132,6 +146,8 @@ class ERSDaemon(object):
         self.prefix = config.prefix()
         self.pidfile = config.pidfile()
         self.tries = config.tries()
+        self.index_backend = config.index_backend()
+        self.warm_indexes = config.warm_indexes()
 
     def start(self):
         """
@@ -143,6 +159,11 @@ class ERSDaemon(object):
         log.debug("Initialise CouchDB")
         self._init_db_connection()
 
+        if self.warm_indexes:
+            log.debug("Start the index warmer")
+            self._warmer = IndexWarmer([self._store[dbname] for dbname in ALL_DBS])
+            self._warmer.start()
+
         log.debug("Publish service on ZeroConf")
         # if the hostname is the same as another node, avahi will not pick up the service
         # so we must add some unique identifier
@@ -169,7 +190,7 @@ class ERSDaemon(object):
         log.debug("Initialise databases")
         for i in range(self.tries):  # @UnusedVariable
             try:
-                self._store = ServiceStore()
+                self._store = ServiceStore(index_backend=self.index_backend)
                 return
             except Exception as e:
                 #raise RuntimeError("Error connecting to CouchDB: {0}".format(str(e)))
@@ -203,6 +224,9 @@ class ERSDaemon(object):
         if self._service is not None:
             self._service.unpublish()
 
+        if self._warmer is not None:
+            self._warmer.stop()
+
         self._peers['contributors'] = {}
         self._peers['bridges'] = {}
         self._update_peers_in_couchdb()
@@ -251,7 +275,7 @@ class ERSDaemon(object):
 
     def _update_peers_in_couchdb(self):
         log.debug("Update peers in CouchDB")
-        state_doc = self._store[ERS_STATE_DB]['_local/state']
+        state_doc = self._store[ERS_STATE_DB].local_state()
         ok = False
         while ok == False:
             # If there are bridges, do not record other peers in the state_doc.
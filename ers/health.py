@@ -0,0 +1,138 @@
+"""
+ers.health
+
+Keeps track of the responsiveness of remote peers.
+
+Every peer has a circuit breaker: it is closed while the peer behaves, opens
+when the peer keeps failing (no queries are sent to it any more) and becomes
+half-open after a while, letting a single probe query through. A successful
+probe closes the circuit again, a failed one re-opens it.
+"""
+
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class PeerHealth(object):
+    """ Moving averages of latency and error rate per peer, and their circuits.
+
+        :param alpha: weight of the newest sample in the moving averages
+        :type alpha: float
+        :param failure_threshold: error rate at which the circuit of a peer opens
+        :type failure_threshold: float
+        :param min_samples: number of queries needed before a circuit can open
+        :type min_samples: int
+        :param open_timeout: seconds before an open circuit lets a probe through
+        :type open_timeout: float
+        :param slow_threshold: answers slower than this (seconds) count as errors
+        :type slow_threshold: float
+    """
+    def __init__(self, alpha=0.3, failure_threshold=0.5, min_samples=3,
+                 open_timeout=30.0, slow_threshold=None):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.min_samples = min_samples
+        self.open_timeout = open_timeout
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._peers = {}
+
+    def _stats(self, url):
+        if url not in self._peers:
+            self._peers[url] = {
+                'state': CLOSED,
+                'latency': None,
+                'error_rate': 0.0,
+                'samples': 0,
+                'opened_at': None,
+                'probing': False
+            }
+        return self._peers[url]
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * current
+
+    def _open(self, stats):
+        stats['state'] = OPEN
+        stats['opened_at'] = time.time()
+
+    def allow(self, url):
+        """ Whether a query should be sent to the peer at <url>.
+
+            Once the open timeout of an open circuit has expired, the first
+            caller gets to send a probe and the circuit becomes half-open.
+        """
+        with self._lock:
+            stats = self._stats(url)
+            if stats['state'] == CLOSED:
+                return True
+            if stats['probing']:
+                return False
+            if stats['state'] == OPEN and time.time() - stats['opened_at'] < self.open_timeout:
+                return False
+            stats['state'] = HALF_OPEN
+            stats['probing'] = True
+            return True
+
+    def release(self, url):
+        """ A query allowed by allow() will not be sent after all.
+        """
+        with self._lock:
+            self._stats(url)['probing'] = False
+
+    def record_success(self, url, latency):
+        with self._lock:
+            stats = self._stats(url)
+            is_slow = self.slow_threshold is not None and latency > self.slow_threshold
+            stats['latency'] = self._average(stats['latency'], latency)
+            stats['error_rate'] = self._average(stats['error_rate'], 1.0 if is_slow else 0.0)
+            stats['samples'] += 1
+            stats['probing'] = False
+            if stats['state'] == HALF_OPEN:
+                stats['state'] = CLOSED
+                stats['error_rate'] = 0.0
+            elif self._is_unhealthy(stats):
+                self._open(stats)
+
+    def record_failure(self, url, latency=None):
+        with self._lock:
+            stats = self._stats(url)
+            if latency is not None:
+                stats['latency'] = self._average(stats['latency'], latency)
+            stats['error_rate'] = self._average(stats['error_rate'], 1.0)
+            stats['samples'] += 1
+            stats['probing'] = False
+            if stats['state'] == HALF_OPEN or self._is_unhealthy(stats):
+                self._open(stats)
+
+    def _is_unhealthy(self, stats):
+        return (stats['samples'] >= self.min_samples and
+                stats['error_rate'] >= self.failure_threshold)
+
+    def order(self, urls):
+        """ Sort peer urls, fastest first. Peers never queried come first so
+            that their latency gets measured.
+        """
+        with self._lock:
+            latencies = dict((url, self._peers[url]['latency'] if url in self._peers else None)
+                             for url in urls)
+        return sorted(urls, key=lambda url: latencies[url] or 0.0)
+
+    def state(self):
+        """ Snapshot of the health of all the known peers.
+
+            :returns: statistics indexed by peer url
+            :rtype: dict
+        """
+        with self._lock:
+            return dict((url, dict(stats)) for url, stats in self._peers.iteritems())
+
+    def forget(self, url):
+        with self._lock:
+            self._peers.pop(url, None)
@@ -0,0 +1,105 @@
+"""
+ers.lru
+
+In-process cache of the local documents of recently read entities.
+
+An entry is only served when the revisions currently emitted by the
+by_entity view of the local databases are exactly those of the cached
+documents, so a hit never returns stale data.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+def signature(rows_by_source):
+    """ Identify the revisions of an entity's documents.
+
+        :param rows_by_source: rows of the by_entity view indexed by source
+        :type rows_by_source: dict
+        :rtype: frozenset
+    """
+    return frozenset((source, row['id'], row['value']['rev'])
+                     for source, rows in rows_by_source.iteritems()
+                     for row in rows)
+
+
+def docs_signature(docs_by_source):
+    """ Same as signature(), computed from the documents themselves.
+    """
+    return frozenset((source, doc['_id'], doc['_rev'])
+                     for source, docs in docs_by_source.iteritems()
+                     for doc in docs)
+
+
+class EntityLRU(object):
+    """ LRU cache of documents by entity, bounded by a number of entities
+        and by the approximate size of their JSON serialization.
+
+        :param max_entries: maximum number of entities kept
+        :type max_entries: int
+        :param max_bytes: maximum total size of the cached documents
+        :type max_bytes: int
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entity_name, revisions):
+        """ Get a copy of the cached documents of <entity_name>, indexed by
+            source, or None if they are not cached at <revisions>.
+        """
+        with self._lock:
+            entry = self._entries.pop(entity_name, None)
+            if entry is None or entry[0] != revisions:
+                if entry is not None:
+                    self._bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries[entity_name] = entry
+            self.hits += 1
+            return deepcopy(entry[1])
+
+    def put(self, entity_name, docs_by_source):
+        size = len(json.dumps(docs_by_source))
+        if size > self.max_bytes:
+            return
+        entry = (docs_signature(docs_by_source), deepcopy(docs_by_source), size)
+        with self._lock:
+            old = self._entries.pop(entity_name, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[entity_name] = entry
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+
+    def invalidate(self, entity_name):
+        with self._lock:
+            entry = self._entries.pop(entity_name, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        """ Approximate size in bytes of the cached documents.
+        """
+        return self._bytes
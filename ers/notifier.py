@@ -0,0 +1,72 @@
+"""
+ers.notifier
+
+Tells the ERS daemon to update its replication links without making the
+writer wait for it.
+
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+import requests
+
+# Seconds during which update requests are gathered into a single one
+DEFAULT_WINDOW = 0.5
+# Seconds to wait for the daemon to answer
+DAEMON_TIMEOUT = 10
+
+log = logging.getLogger('ers')
+
+
+class ReplicationNotifier(object):
+    """ Sends update requests to the daemon from a background thread.
+
+        All the calls to notify() made within <window> seconds of the first
+        pending one are coalesced into one request.
+
+        :param url: daemon URL to call
+        :type url: str
+        :param window: coalescing window in seconds
+        :type window: float
+    """
+    def __init__(self, url, window=DEFAULT_WINDOW):
+        self.url = url
+        self.window = window
+        self._pending = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        """ Ask for an update, returns immediately.
+        """
+        self._pending.set()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='ers-replication-notifier')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def flush(self):
+        """ Send the pending request now, if any.
+        """
+        if self._pending.is_set():
+            self._send()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            # Let more requests come in during the window
+            time.sleep(self.window)
+            self._send()
+
+    def _send(self):
+        self._pending.clear()
+        try:
+            requests.get(self.url, timeout=DAEMON_TIMEOUT)
+        except Exception as e:
+            log.warning("Failed to trigger replication update: {0}".format(e))
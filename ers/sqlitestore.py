@@ -0,0 +1,425 @@
+"""
+ers.sqlitestore
+
+Local ERS store kept in SQLite files, for small nodes that do not run
+CouchDB. Each database answers the queries of ers.store.ERSDatabase from
+SQL indexes on the entity of the documents and on their (property, value)
+statements instead of views, without any HTTP round trip.
+
+Only the winning revision of a document is kept and only string values
+are indexed. The databases cannot be replicated to or queried by peers.
+
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import md5
+from itertools import count
+from uuid import uuid4
+
+from couchdb import http
+from couchdb.client import Document
+
+from store import BaseStore, ALL_DBS, ERS_STATE_DB, PAGE_SIZE, property_range, state_doc, to_unicode
+
+DEFAULT_SQLITE_PATH = os.path.join(os.path.expanduser('~'), '.ers', 'sqlite')
+# Seconds between two checks for changes of a long poll
+LONGPOLL_INTERVAL = 0.1
+# Maximum number of parameters of one SQL statement (SQLite allows 999)
+MAX_PARAMS = 500
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS docs (
+        id TEXT PRIMARY KEY,
+        rev TEXT NOT NULL,
+        seq INTEGER,
+        entity TEXT,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        body TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS docs_by_entity ON docs (entity);
+    CREATE UNIQUE INDEX IF NOT EXISTS docs_by_seq ON docs (seq);
+    CREATE TABLE IF NOT EXISTS statements (
+        doc_id TEXT NOT NULL,
+        entity TEXT NOT NULL,
+        property TEXT NOT NULL,
+        value TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS statements_by_property_value ON statements (property, value, doc_id);
+    CREATE INDEX IF NOT EXISTS statements_by_doc ON statements (doc_id);
+"""
+
+
+def revision_key(rev):
+    """ Sort key of a revision, the winning revision of a document being
+        the greatest one (as in CouchDB).
+    """
+    generation, digest = rev.split('-', 1)
+    return int(generation), digest
+
+
+def statements(doc):
+    """ (property, value) pairs of a document, as indexed by the
+        by_property_value view.
+    """
+    for prop, values in doc.iteritems():
+        if prop.startswith('_') or prop.startswith('@'):
+            continue
+        if isinstance(values, basestring):
+            values = [values]
+        elif not isinstance(values, list):
+            continue
+        for value in values:
+            if isinstance(value, basestring):
+                yield prop, value
+
+
+class SQLiteDatabase(object):
+    """ One ERS database in an SQLite file, with the methods of
+        ers.store.ERSDatabase and those of couchdb.client.Database used by
+        ERS (get, save, update, delete, changes, info).
+
+        Each thread gets its own connection.
+
+        :param path: file of the database
+        :type path: str
+        :param name: name of the database (e.g. 'ers-public')
+        :type name: str
+    """
+    # Accepted for compatibility with ERSDatabase, the SQL indexes are always up to date
+    index_backend = None
+    stale = None
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def __repr__(self):
+        return '<SQLiteDatabase {0!r}>'.format(self.name)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _query(self, sql, params=()):
+        # sqlite3 only binds byte strings holding ASCII
+        return self._connection().execute(sql, [to_unicode(param) for param in params]).fetchall()
+
+    def _chunks(self, values):
+        values = list(values)
+        for i in xrange(0, len(values), MAX_PARAMS):
+            yield values[i:i + MAX_PARAMS]
+
+    # Documents
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+    def __getitem__(self, doc_id):
+        doc = self.get(doc_id)
+        if doc is None:
+            raise http.ResourceNotFound(('not_found', 'missing'))
+        return doc
+
+    def local_state(self):
+        """ The state document of the node (in ers-state).
+        """
+        return self['_local/state']
+
+    def get(self, doc_id, default=None):
+        rows = self._query('SELECT id, rev, body FROM docs WHERE id = ? AND deleted = 0', (doc_id,))
+        if not rows:
+            return default
+        return self._document(*rows[0])
+
+    def _document(self, doc_id, rev, body):
+        doc = Document(json.loads(body))
+        doc['_id'] = doc_id
+        doc['_rev'] = rev
+        return doc
+
+    def save(self, doc):
+        """ Create or update a document, setting its _id and _rev.
+
+            :raises couchdb.http.ResourceConflict: if _rev is not the current revision
+            :returns: id and revision of the document
+            :rtype: tuple
+        """
+        success, doc_id, rev = self.update([doc])[0]
+        if not success:
+            raise rev
+        return doc_id, rev
+
+    def delete(self, doc):
+        tombstone = {'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True}
+        self.save(tombstone)
+
+    def update(self, documents, new_edits=True):
+        """ Write several documents in one transaction, as a _bulk_docs request.
+
+            :param new_edits: False to store the documents with their own
+                revision (replicas), keeping the winning revision
+            :returns: list of (success, doc_id, rev) tuples, where rev is the
+                exception on failure
+            :rtype: list
+        """
+        with self._transaction() as conn:
+            last_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM docs').fetchone()[0]
+            seqs = count(last_seq + 1)
+            return [self._write(conn, doc, new_edits, seqs) for doc in documents]
+
+    def _write(self, conn, doc, new_edits, seqs):
+        doc_id = to_unicode(doc.get('_id') or uuid4().hex)
+        is_local = doc_id.startswith('_local/')
+        row = conn.execute('SELECT rev, deleted FROM docs WHERE id = ?', (doc_id,)).fetchone()
+        current_rev, was_deleted = row if row is not None else (None, True)
+
+        content = dict((key, value) for key, value in doc.iteritems() if key not in ('_id', '_rev'))
+        body = json.dumps(content)
+        if not new_edits:
+            rev = doc['_rev']
+            if current_rev is not None and revision_key(rev) <= revision_key(current_rev):
+                return True, doc_id, rev
+        elif doc.get('_rev') != current_rev and not (was_deleted and '_rev' not in doc):
+            return False, doc_id, http.ResourceConflict(('conflict', 'Document update conflict.'))
+        else:
+            generation = revision_key(current_rev)[0] + 1 if current_rev is not None else 1
+            rev = '{0}-{1}'.format(generation, '0' if is_local else md5(body).hexdigest())
+
+        deleted = bool(content.get('_deleted'))
+        entity = None if deleted or is_local else to_unicode(content.get('@id'))
+        seq = None if is_local else next(seqs)
+        conn.execute('INSERT OR REPLACE INTO docs (id, rev, seq, entity, deleted, body) VALUES (?, ?, ?, ?, ?, ?)',
+                     (doc_id, rev, seq, entity, int(deleted), body))
+        conn.execute('DELETE FROM statements WHERE doc_id = ?', (doc_id,))
+        if entity is not None:
+            conn.executemany('INSERT INTO statements (doc_id, entity, property, value) VALUES (?, ?, ?, ?)',
+                             [(doc_id, entity, to_unicode(prop), to_unicode(value))
+                              for prop, value in statements(content)])
+        if new_edits:
+            doc['_id'] = doc_id
+            doc['_rev'] = rev
+        return True, doc_id, rev
+
+    def clear(self):
+        """ Remove all the documents.
+        """
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM docs')
+            conn.execute('DELETE FROM statements')
+
+    def changes(self, since=0, limit=None, feed=None, timeout=None, **opts):
+        """ Changes of the documents after sequence <since>, as the _changes
+            feed. A 'longpoll' feed waits up to <timeout> milliseconds for one.
+        """
+        deadline = time.time() + (timeout or 0) / 1000.0
+        while True:
+            sql = 'SELECT seq, id, rev, deleted FROM docs WHERE seq > ? ORDER BY seq'
+            if limit:
+                sql += ' LIMIT {0:d}'.format(limit)
+            rows = self._query(sql, (since,))
+            if rows or feed != 'longpoll' or time.time() >= deadline:
+                break
+            time.sleep(LONGPOLL_INTERVAL)
+
+        results = []
+        for seq, doc_id, rev, deleted in rows:
+            change = {'seq': seq, 'id': doc_id, 'changes': [{'rev': rev}]}
+            if deleted:
+                change['deleted'] = True
+            results.append(change)
+        return {'results': results, 'last_seq': rows[-1][0] if rows else since}
+
+    def info(self):
+        doc_count, update_seq = self._query('SELECT COALESCE(SUM(deleted = 0), 0), COALESCE(MAX(seq), 0) '
+                                            'FROM docs WHERE seq IS NOT NULL')[0]
+        return {'db_name': self.name, 'doc_count': doc_count, 'update_seq': update_seq}
+
+    def refresh_index(self):
+        """ Nothing to do, the indexes are updated with the documents.
+        """
+
+    # Entity index
+
+    def docs_by_entity(self, entity_name):
+        return [self._document(*row) for row in
+                self._query('SELECT id, rev, body FROM docs WHERE entity = ? ORDER BY id', (entity_name,))]
+
+    def docs_by_entities(self, entity_names):
+        """ Get the documents of several entities.
+
+            :returns: list of (entity_name, document) pairs
+        """
+        pairs = []
+        for chunk in self._chunks(entity_names):
+            rows = self._query('SELECT entity, id, rev, body FROM docs WHERE entity IN ({0}) ORDER BY entity, id'
+                               .format(','.join('?' * len(chunk))), chunk)
+            pairs.extend((row[0], self._document(*row[1:])) for row in rows)
+        return pairs
+
+    def _entity_rows(self, rows):
+        return [{'id': doc_id, 'key': entity, 'value': {'rev': rev, 'g': doc_id}}
+                for entity, doc_id, rev in rows]
+
+    def by_entity(self, entity_name):
+        return self._entity_rows(self._query('SELECT entity, id, rev FROM docs WHERE entity = ? ORDER BY id',
+                                             (entity_name,)))
+
+    def by_entities(self, entity_names):
+        rows = []
+        for chunk in self._chunks(entity_names):
+            rows.extend(self._query('SELECT entity, id, rev FROM docs WHERE entity IN ({0}) ORDER BY entity, id'
+                                    .format(','.join('?' * len(chunk))), chunk))
+        return self._entity_rows(rows)
+
+    def entity_ids(self):
+        return [row[0] for row in self._query('SELECT id FROM docs WHERE entity IS NOT NULL ORDER BY entity')]
+
+    def entity_exist(self, entity_name):
+        return len(self._query('SELECT 1 FROM docs WHERE entity = ? LIMIT 1', (entity_name,))) > 0
+
+    # Property index
+
+    def _property_condition(self, prop, value=None):
+        """ SQL condition and parameters selecting the statements matching
+            <prop> [= <value>], see ers.store.property_range.
+        """
+        startkey, endkey = property_range(prop, value)
+        conditions, params = ['property = ?'], [prop]
+        if len(startkey) > 1:
+            conditions.append('value >= ?')
+            params.append(startkey[1])
+        if endkey[1] != {}:
+            conditions.append('value <= ?')
+            params.append(endkey[1])
+        return ' AND '.join(conditions), params
+
+    def by_property(self, prop):
+        return self.by_property_value(prop)
+
+    def by_property_value(self, prop, value=None):
+        condition, params = self._property_condition(prop, value)
+        return [row[0] for row in self._query('SELECT entity FROM statements WHERE ' + condition +
+                                              ' ORDER BY value, doc_id', params)]
+
+    def page_by_property_value(self, prop, value=None, limit=PAGE_SIZE, cursor=None):
+        """ Get one page of the entities having property <prop> [with value <value>].
+
+            :param cursor: position returned with the previous page, None for the first page
+            :type cursor: tuple
+            :returns: list of entity names and cursor of the next page (None after the last one)
+            :rtype: tuple
+        """
+        if limit < 1:
+            raise ValueError("The page limit must be at least 1, got {0}".format(limit))
+        condition, params = self._property_condition(prop, value)
+        if cursor is not None:
+            (_, start_value), start_id = cursor
+            condition += ' AND (value > ? OR (value = ? AND doc_id >= ?))'
+            params.extend([start_value, start_value, start_id])
+        rows = self._query('SELECT entity, value, doc_id FROM statements WHERE ' + condition +
+                           ' ORDER BY value, doc_id LIMIT ?', params + [limit + 1])
+
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = ([prop, rows[limit][1]], rows[limit][2])
+            rows = rows[:limit]
+        return [row[0] for row in rows], next_cursor
+
+    def iter_by_property_value(self, prop, value=None, page_size=PAGE_SIZE):
+        cursor = None
+        while True:
+            names, cursor = self.page_by_property_value(prop, value, page_size, cursor)
+            for name in names:
+                yield name
+            if cursor is None:
+                return
+
+    def count_by_property_value(self, prop, value=None):
+        condition, params = self._property_condition(prop, value)
+        return self._query('SELECT COUNT(*) FROM statements WHERE ' + condition, params)[0][0]
+
+    def facets_by_property(self, prop):
+        return dict(self._query('SELECT value, COUNT(*) FROM statements WHERE property = ? GROUP BY value',
+                                (prop,)))
+
+    # Deletions and replicas
+
+    def delete_entity(self, entity_name):
+        return self.delete_entities([entity_name])
+
+    def delete_entities(self, entity_names):
+        docs = [{'_id': r['id'], '_rev': r['value']['rev'], '_deleted': True, '@id': r['key']}
+                for r in self.by_entities(set(entity_names))]
+        if not docs:
+            return True
+        return all(success for success, _, _ in self.update(docs))
+
+    def missing_revisions(self, docs):
+        """ (_id, _rev) pairs of <docs> newer than the revisions held.
+        """
+        missing = set()
+        for doc in docs:
+            rows = self._query('SELECT rev FROM docs WHERE id = ?', (doc['_id'],))
+            if not rows or revision_key(doc['_rev']) > revision_key(rows[0][0]):
+                missing.add((doc['_id'], doc['_rev']))
+        return missing
+
+    def save_replicas(self, docs):
+        missing = self.missing_revisions(docs)
+        replicas = []
+        for doc in docs:
+            if (doc['_id'], doc['_rev']) in missing:
+                missing.discard((doc['_id'], doc['_rev']))
+                replicas.append(doc)
+        if replicas:
+            self.update(replicas, new_edits=False)
+        return len(replicas)
+
+
+class SQLiteStore(BaseStore):
+    """
+        ERS store kept in one SQLite file per database under <path>.
+    """
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        super(SQLiteStore, self).__init__()
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for dbname in [ERS_STATE_DB] + ALL_DBS:
+            self._ers_dbs[dbname] = SQLiteDatabase(os.path.join(path, dbname + '.sqlite'), dbname)
+
+        state_db = self._ers_dbs[ERS_STATE_DB]
+        if '_local/state' not in state_db:
+            state_db.save(state_doc())
+        if '_local/node' not in state_db:
+            state_db.save({'_id': '_local/node', 'uuid': uuid4().hex})
+
+    def reset(self):
+        for dbname in ALL_DBS:
+            self[dbname].clear()
+
+    def info(self):
+        return {'uuid': self[ERS_STATE_DB]['_local/node']['uuid']}
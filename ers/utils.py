@@ -1,34 +1,495 @@
-from collections import defaultdict
+import argparse
+import hashlib
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import defaultdict, OrderedDict
+from itertools import islice
 from StringIO import StringIO
 
+import concurrent.futures
 import rdflib
 
-def import_nt(registry, file_name, target_graph):
+from . import store
+from .api import ERS, Entity
+from .store import ERS_STATE_DB
+
+# Number of entities written per _bulk_docs request
+DEFAULT_CHUNK_SIZE = 500
+# Byte ranges per process in parallel imports, for balancing the work
+RANGES_PER_PROCESS = 4
+# Attempts at writing an entity whose documents are changed by someone else
+IMPORT_WRITE_TRIES = 3
+# Kinds of import checkpoints
+IMPORT_SEQUENTIAL = 'sequential'
+IMPORT_PARALLEL = 'parallel'
+
+def import_nt(registry, file_name, private=False, chunk_size=DEFAULT_CHUNK_SIZE, resume=True):
     """ Import N-Triples file.
 
+        The file is streamed: the triples of consecutive lines sharing a
+        subject make up one entity, and entities are written in chunks of
+        <chunk_size>, so memory use does not depend on the size of the file.
+        Input grouped by subject (e.g. sorted) gives one write per entity.
+
+        A checkpoint is saved in ers-state after every chunk. Importing the
+        same, unchanged file again after an interruption starts from the
+        last checkpoint, and the statements written again since then change
+        nothing (see load_entities).
+
         :param registry: registry used for writing the data
         :type registry: ERS instance
         :param file_name: file name
         :type file_name: str.
-        :param target_graph: graph to write to
-        :type target_graph: str.
+        :param private: whether to write the statements to the private documents
+        :type private: bool.
+        :param chunk_size: number of entities per bulk write
+        :type chunk_size: int.
+        :param resume: whether to start from the checkpoint of a previous import
+        :type resume: bool.
+        :returns: statistics of the import
+        :rtype: dict
     """
-    cache = EntityCache().parse_nt(filename=file_name)
-    registry.write_cache(cache, target_graph)
+    checkpoint = ImportCheckpoint(registry, file_name)
+    state = checkpoint.load(IMPORT_SEQUENTIAL)
+    start, batch = (state['offset'], state['batch']) if state and resume else (0, 0)
+    progress = {'offset': 0}
+
+    def on_write(batches):
+        # The entity being read started in the current block, everything
+        # before that block has been written
+        checkpoint.save(IMPORT_SEQUENTIAL, offset=start + progress['offset'], batch=batch + batches)
 
-def import_nt_rdflib(registry, file_name, target_graph):
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        stats = load_entities(registry, group_by_subject(iter_nt(f, progress)), private, chunk_size, on_write)
+    checkpoint.clear()
+    return stats
+
+def import_nt_rdflib(registry, file_name, private=False, chunk_size=DEFAULT_CHUNK_SIZE):
     """ Import N-Triples file using rdflib.
 
         :param registry: registry used for writing the data
         :type registry: ERS instance
         :param file_name: file name
         :type file_name: str.
-        :param target_graph: graph to write to
-        :type target_graph: str.
+        :param private: whether to write the statements to the private documents
+        :type private: bool.
+        :param chunk_size: number of entities per bulk write
+        :type chunk_size: int.
+        :returns: statistics of the import
+        :rtype: dict
     """
-    # TODO: get rid of the intermediate cache?
     cache = EntityCache().parse_nt_rdflib(filename=file_name)
-    registry.write_cache(cache, target_graph)
+    entities = ((s, [(p, o) for p, objects in properties.iteritems() for o in objects])
+                for s, properties in cache.iteritems())
+    return load_entities(registry, entities, private, chunk_size)
+
+class NTriplesSyntaxError(ValueError):
+    pass
+
+# Size of the blocks read from N-Triples files
+READ_BLOCK_SIZE = 1 << 20
+
+# Single character exclusions are much faster than [^>\n] in re, a term
+# running over the end of its line is caught by counting the matched lines
+_IRI = r'<([^>]+)>'
+_BNODE = r'(_:[^\s.]+(?:\.+[^\s.]+)*)'
+_LITERAL = r'"([^"\\]*(?:\\.[^"\\]*)*)"(?:\^\^<([^>]+)>|@([a-zA-Z]+(?:-[a-zA-Z0-9]+)*))?'
+# One line: a triple, a comment or nothing
+_LINE = re.compile(r'^[ \t]*(?:(?:{iri}|{bnode})[ \t]+{iri}[ \t]+(?:{iri}|{bnode}|{literal})[ \t]*\.[ \t]*(?:#[^\n]*)?|(?:#[^\n]*)?)\r?\n'.format(
+    iri=_IRI, bnode=_BNODE, literal=_LITERAL), re.M)
+_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_ESCAPED_CHARS = {'t': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f',
+                  '"': u'"', "'": u"'", '\\': u'\\'}
+
+def _unescape_match(match):
+    short, long_, char = match.groups()
+    if char is not None:
+        if char not in _ESCAPED_CHARS:
+            raise NTriplesSyntaxError("Invalid escape sequence \\{0}".format(char))
+        return _ESCAPED_CHARS[char]
+    code = int(short or long_, 16)
+    try:
+        return unichr(code)
+    except ValueError:
+        # Narrow Python build, use a surrogate pair
+        code -= 0x10000
+        return unichr(0xD800 + (code >> 10)) + unichr(0xDC00 + (code & 0x3FF))
+
+def _unescape(value):
+    if '\\' not in value:
+        return value
+    return _ESCAPE.sub(_unescape_match, value)
+
+def _read_blocks(source, block_size):
+    """ Cut N-Triples data into blocks of whole lines, each ending with a newline.
+    """
+    if hasattr(source, 'read'):
+        read = lambda: source.read(block_size)
+    else:
+        lines = iter(source)
+        read = lambda: '\n'.join(line.rstrip('\n') for line in islice(lines, 1000)) + '\n'
+    rest = ''
+    while True:
+        block = read()
+        if not block or block == '\n':
+            break
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+    if rest:
+        yield rest + '\n'
+
+def tokenize_nt(source, block_size=None, progress=None):
+    """ Tokenize N-Triples.
+
+        The data is decoded as UTF-8 and all the terms are returned as
+        unicode: blank nodes as '_:label', IRIs without their <>, with their
+        escape sequences decoded.
+
+        :param source: file object, read in blocks of <block_size> bytes, or iterable of lines
+        :param progress: if given, progress['offset'] is kept set to the offset
+            in bytes, from where reading started, of the block whose triples
+            are being returned
+        :type progress: dict
+        :returns: iterator over (subject, property, object, datatype, lang) tuples,
+            datatype and lang being None unless the object is a typed or tagged literal
+        :raises: NTriplesSyntaxError on lines which are not valid N-Triples
+    """
+    lines_before = 0
+    offset = 0
+    for block in _read_blocks(source, block_size or READ_BLOCK_SIZE):
+        if progress is not None:
+            progress['offset'] = offset
+        offset += len(block)
+        if not isinstance(block, unicode):
+            try:
+                block = block.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise NTriplesSyntaxError("Invalid UTF-8 in N-Triples: {0}".format(e))
+        lines = _LINE.findall(block)
+        if len(lines) != block.count('\n'):
+            _raise_syntax_error(block, lines_before)
+        lines_before += len(lines)
+
+        for s, s_bnode, p, o, o_bnode, o_literal, datatype, lang in lines:
+            if not p:
+                # Blank or comment line
+                continue
+            if not s:
+                s = s_bnode
+            elif '\\' in s:
+                s = _unescape(s)
+            if '\\' in p:
+                p = _unescape(p)
+            if not o:
+                o = o_literal if o_bnode == '' else o_bnode
+            if '\\' in o:
+                o = _unescape(o)
+            yield (s, p, o, datatype or None, lang or None)
+
+def _raise_syntax_error(block, lines_before):
+    position = 0
+    for m in _LINE.finditer(block):
+        if m.start() != position or block.count('\n', position, m.end()) > 1:
+            break
+        position = m.end()
+    line_number = lines_before + block.count('\n', 0, position) + 1
+    line = block[position:block.find('\n', position)]
+    raise NTriplesSyntaxError("Invalid N-Triples on line {0}: {1}".format(line_number, line))
+
+def iter_nt(source, progress=None):
+    """ Iterate over the (subject, property, object) triples of N-Triples
+        data, see tokenize_nt.
+    """
+    for s, p, o, _, _ in tokenize_nt(source, progress=progress):
+        yield (s, p, o)
+
+def group_by_subject(triples):
+    """ Group consecutive triples sharing their subject.
+
+        :returns: iterator over (subject, [(property, object), ...]) pairs
+    """
+    subject, statements = None, []
+    for s, p, o in triples:
+        if s != subject:
+            if statements:
+                yield subject, statements
+            subject, statements = s, []
+        statements.append((p, o))
+    if statements:
+        yield subject, statements
+
+def import_document_id(registry, subject, scope):
+    """ Id given to the <scope> document of <subject> when an import creates
+        it. It is the same on every run, so that two imports of the same
+        entity cannot both create one.
+    """
+    if isinstance(subject, unicode):
+        subject = subject.encode('utf-8')
+    return hashlib.md5(' '.join([registry.host_urn, scope, subject])).hexdigest()
+
+def load_entities(registry, entities, private=False, chunk_size=DEFAULT_CHUNK_SIZE, on_write=None):
+    """ Write entities with ERS.persist_entities, <chunk_size> at a time.
+
+        The statements are added to the stored descriptions of the entities,
+        read with one get_many per chunk. Values are sets, so loading the
+        same statements again changes nothing; byte strings are decoded as
+        UTF-8 so that they compare equal to the stored values. Documents
+        created get their id from import_document_id; when a document was
+        written by someone else in the meantime, the entity is read and
+        merged again, up to IMPORT_WRITE_TRIES times.
+
+        :param registry: registry used for writing the data
+        :type registry: ERS instance
+        :param entities: iterable of (subject, [(property, object), ...]) pairs
+        :type entities: iterable
+        :param on_write: called with the number of chunks written after each chunk
+        :type on_write: callable
+        :returns: numbers of entities created, statements, chunks written and
+            entities which could not be written
+        :rtype: dict
+    """
+    scope = 'private' if private else 'public'
+    stats = {'entities': 0, 'statements': 0, 'batches': 0, 'failures': 0}
+    chunk = OrderedDict()
+
+    def write_chunk():
+        pending = chunk
+        created = {}
+        for _ in xrange(IMPORT_WRITE_TRIES):
+            stored = registry.get_many(pending.keys(), include_remote=False)
+            targets = []
+            for subject, statements in pending.iteritems():
+                # Only the document of <scope> is written
+                target = Entity(subject)
+                document = stored[subject].get_documents(scope)
+                values = {}
+                if document is not None:
+                    target.add_document(document.to_json(), scope)
+                    values = _value_sets(document.to_json())
+                created[subject] = document is None
+                for p, o in statements:
+                    # Values are a set, a statement already there is skipped
+                    if o not in values.setdefault(p, set()):
+                        values[p].add(o)
+                        target.add(p, o, private)
+                if created[subject]:
+                    target.get_documents(scope).to_json()['_id'] = import_document_id(registry, subject, scope)
+                targets.append(target)
+            results = registry.persist_entities(targets, chunk_size=len(targets))
+            failed = set(result[0] for result in results if not result[2])
+            pending = OrderedDict((subject, statements) for subject, statements in pending.iteritems()
+                                  if subject in failed)
+            if not pending:
+                break
+
+        stats['entities'] += sum(1 for subject, is_new in created.iteritems() if is_new and subject not in pending)
+        stats['failures'] += len(pending)
+        stats['batches'] += 1
+        chunk.clear()
+        if on_write is not None:
+            on_write(stats['batches'])
+
+    for subject, statements in entities:
+        # Stored values come back as unicode, compare them with unicode
+        subject = store.to_unicode(subject)
+        chunk.setdefault(subject, []).extend((store.to_unicode(p), store.to_unicode(o))
+                                             for p, o in statements)
+        stats['statements'] += len(statements)
+        if len(chunk) >= chunk_size:
+            write_chunk()
+    if chunk:
+        write_chunk()
+
+    return stats
+
+def _value_sets(doc):
+    """ Sets of the string values of each property of a document.
+    """
+    values = {}
+    for prop, value in doc.iteritems():
+        if prop.startswith('_') or prop.startswith('@'):
+            continue
+        for v in (value if isinstance(value, list) else [value]):
+            if isinstance(v, basestring):
+                values.setdefault(prop, set()).add(v)
+    return values
+
+class ImportCheckpoint(object):
+    """ Progress of the import of a file, kept in a _local document of
+        ers-state. A checkpoint is only returned for the same file, at the
+        same size and modification time.
+
+        :param registry: registry the file is imported into
+        :type registry: ERS instance
+        :param file_name: file name
+        :type file_name: str.
+    """
+    def __init__(self, registry, file_name):
+        self._db = registry.store[ERS_STATE_DB]
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        self._id = '_local/import-' + hashlib.md5(path).hexdigest()
+        self._file = {'file': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        self._doc = None
+
+    def load(self, mode):
+        """ Get the saved state of an import in <mode>, or None.
+        """
+        self._doc = self._db.get(self._id)
+        if self._doc is None or self._doc.get('mode') != mode:
+            return None
+        if any(self._doc.get(key) != value for key, value in self._file.iteritems()):
+            return None
+        return self._doc
+
+    def save(self, mode, **state):
+        doc = {'_id': self._id, 'mode': mode}
+        doc.update(self._file)
+        doc.update(state)
+        if self._doc is not None:
+            doc['_rev'] = self._doc['_rev']
+        self._db.save(doc)
+        self._doc = doc
+
+    def clear(self):
+        if self._doc is not None:
+            self._db.delete(self._doc)
+            self._doc = None
+
+def import_nt_parallel(registry, file_name, processes=None, private=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                       resume=True):
+    """ Import N-Triples file with a pool of processes.
+
+        The file is cut into byte ranges on line boundaries, a few per
+        process. Each worker parses its range, groups it by subject and
+        writes the entities through its own ERS instance, except the first
+        and last ones of the range, which may continue in the neighbouring
+        ranges. Those partial entities are sent back, merged with their
+        other parts, and written by the calling process.
+
+        A checkpoint listing the ranges done, and the partial entity still
+        waiting for the next range, is saved in ers-state as the ranges
+        complete, so an interrupted import only redoes the ranges that
+        were not finished (see import_nt).
+
+        :param registry: registry used for writing the merged entities
+        :type registry: ERS instance
+        :param file_name: file name
+        :type file_name: str.
+        :param processes: number of worker processes, the number of CPUs by default
+        :type processes: int.
+        :param resume: whether to start from the checkpoint of a previous import
+        :type resume: bool.
+        :returns: statistics of the import
+        :rtype: dict
+    """
+    processes = processes or multiprocessing.cpu_count()
+    checkpoint = ImportCheckpoint(registry, file_name)
+    state = checkpoint.load(IMPORT_PARALLEL)
+    if state and resume:
+        ranges, done, open_edges = state['ranges'], state['done'], state['pending']
+    else:
+        ranges, done, open_edges = split_lines(file_name, processes * RANGES_PER_PROCESS), 0, []
+    tasks = [(file_name, start, end, private, chunk_size) for start, end in ranges[done:]]
+
+    stats = {'entities': 0, 'statements': 0, 'batches': 0, 'failures': 0}
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(registry.store_options,))
+    try:
+        for index, (range_stats, range_edges) in enumerate(pool.imap(_import_range, tasks), done + 1):
+            # Only the last entity received may continue in the next range
+            edges = list(group_by_subject((s, p, o) for s, statements in open_edges + range_edges
+                                          for p, o in statements))
+            open_edges = edges[-1:]
+            edge_stats = load_entities(registry, edges[:-1], private, chunk_size)
+            for key in stats:
+                stats[key] += range_stats[key] + edge_stats[key]
+            checkpoint.save(IMPORT_PARALLEL, ranges=ranges, done=index, pending=open_edges)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    edge_stats = load_entities(registry, open_edges, private, chunk_size)
+    for key in stats:
+        stats[key] += edge_stats[key]
+    checkpoint.clear()
+    return stats
+
+def split_lines(file_name, parts):
+    """ Cut a file into at most <parts> byte ranges starting at the
+        beginning of a line.
+
+        :returns: list of (start, end) offsets
+        :rtype: list
+    """
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as f:
+        for i in xrange(1, parts):
+            f.seek(max(size * i // parts, offsets[-1]))
+            if f.tell() > 0:
+                # Move on to the start of the next line
+                f.seek(-1, os.SEEK_CUR)
+                f.readline()
+            if f.tell() < size and f.tell() > offsets[-1]:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+class _RangeReader(object):
+    """ File object reading <length> bytes from the current position of <f>.
+    """
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+
+    def read(self, size):
+        data = self._f.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+_worker_registry = None
+
+def _init_worker(store_options):
+    global _worker_registry
+    # Threads do not survive fork(), the pool of the parent process is unusable
+    store._local_pool = concurrent.futures.ThreadPoolExecutor(max_workers=store.LOCAL_QUERY_WORKERS)
+    # Write to the same local store as the registry of the parent process
+    _worker_registry = ERS(local_only=True, **store_options)
+
+def _split_edges(groups, edges):
+    """ Yield all the groups but the first and the last, which are
+        appended to <edges>.
+    """
+    first = next(groups, None)
+    if first is None:
+        return
+    edges.append(first)
+    previous = None
+    for group in groups:
+        if previous is not None:
+            yield previous
+        previous = group
+    if previous is not None:
+        edges.append(previous)
+
+def _import_range(task):
+    file_name, start, end, private, chunk_size = task
+    edges = []
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        groups = group_by_subject(iter_nt(_RangeReader(f, end - start)))
+        stats = load_entities(_worker_registry, _split_edges(groups, edges), private, chunk_size)
+    return stats, edges
 
 class EntityCache(defaultdict):
     """ Equivalent to defaultdict(lambda: defaultdict(set)).
@@ -54,27 +515,15 @@ class EntityCache(defaultdict):
             :returns: self
         """
         if 'filename' in kwargs:
-            lines = open(kwargs['filename'], 'r')
+            with open(kwargs['filename'], 'r') as source:
+                for s, p, o in iter_nt(source):
+                    self.add(s, p, o)
         elif 'data' in kwargs:
-            lines = StringIO(kwargs['data'])
+            for s, p, o in iter_nt(StringIO(kwargs['data'])):
+                self.add(s, p, o)
         else:
             raise RuntimeError("Must specify filename= or data= for parse_nt")
 
-        for input_line in lines:
-            triple = input_line.split(None, 2) # assumes SPO is separated by any whitespace string with leading and trailing spaces ignored
-            s = triple[0][1:-1] # get rid of the <>, naively assumes no bNodes for now
-            p = triple[1][1:-1] # get rid of the <>
-            o = triple[2][1:-1] # get rid of the <> or "", naively assumes no bNodes for now
-            oquote = triple[2][0]
-            if oquote == '"':
-                o = triple[2][1:].rsplit('"')[0]
-            elif oquote == '<':
-                o = triple[2][1:].rsplit('>')[0]
-            else:
-                o = triple[2].split(' ')[0] # might be a named node
-
-            self.add(s, p, o)
-
         return self
 
     def parse_nt_rdflib(self, **kwargs):
@@ -92,9 +541,39 @@ class EntityCache(defaultdict):
             raise RuntimeError("Must specify filename= or data= for parse_nt_rdflib")
 
         for s, p, o in graph:
-            self.add(str(s), str(p), str(o))
+            self.add(unicode(s), unicode(p), unicode(o))
 
         return self
 
+def main(argv=None):
+    """ Entry point of the ers-import command.
+    """
+    parser = argparse.ArgumentParser(description="Import N-Triples files into the local ERS store")
+    parser.add_argument("files", nargs='+', help="N-Triples files to import")
+    parser.add_argument("-p", "--private", help="write the statements to the private documents",
+                        action="store_true")
+    parser.add_argument("-c", "--chunk-size", help="number of entities per bulk write",
+                        type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("-j", "--processes", help="import with this many processes (0 for one per CPU)",
+                        type=int, default=1)
+    parser.add_argument("--restart", help="ignore the checkpoint of an interrupted import",
+                        action="store_true")
+    args = parser.parse_args(argv)
+
+    registry = ERS(local_only=True)
+    for file_name in args.files:
+        start = time.time()
+        if args.processes == 1:
+            stats = import_nt(registry, file_name, args.private, args.chunk_size, not args.restart)
+        else:
+            stats = import_nt_parallel(registry, file_name, args.processes or None,
+                                       args.private, args.chunk_size, not args.restart)
+        elapsed = time.time() - start
+        print "{0}: {1} statements, {2} new entities in {3:.2f} s ({4:.0f} statements/s), {5} entities not written".format(
+            file_name, stats['statements'], stats['entities'], elapsed,
+            stats['statements'] / elapsed if elapsed else 0, stats['failures'])
+        if stats['failures']:
+            sys.exit(1)
+
 if __name__ == '__main__':
-    print "To test this module use 'python ../../tests/test_utils.py'."
+    main()
@@ -0,0 +1,80 @@
+"""
+ers.warmer
+
+Keeps the indexes of the local databases up to date in the background, so
+that reads with stale=ok or stale=update_after find them hot and no read
+waits for CouchDB to index a burst of writes.
+
+"""
+
+import logging
+import threading
+
+# Seconds during which changes are gathered before updating the indexes
+DEFAULT_WINDOW = 1.0
+# Milliseconds a long poll of the _changes feed waits for a change
+POLL_TIMEOUT = 30000
+# Seconds to wait after a failure before following the database again
+RETRY_DELAY = 5.0
+
+log = logging.getLogger('ers')
+
+
+class IndexWarmer(object):
+    """ Follows the _changes feed of databases, one thread per database, and
+        updates their indexes after each burst of writes.
+
+        :param databases: databases to keep warm
+        :type databases: list of ERSDatabase
+        :param window: seconds to wait after a change for the rest of the burst
+        :type window: float
+        :param poll_timeout: milliseconds a long poll waits for a change
+        :type poll_timeout: int
+    """
+    def __init__(self, databases, window=DEFAULT_WINDOW, poll_timeout=POLL_TIMEOUT):
+        self.databases = list(databases)
+        self.window = window
+        self.poll_timeout = poll_timeout
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """ Warm the indexes and keep following the databases.
+        """
+        self._stopped.clear()
+        for db in self.databases:
+            thread = threading.Thread(target=self._run, args=(db,), name='ers-index-warmer-' + db.name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stop following the databases. Pending long polls are abandoned.
+        """
+        self._stopped.set()
+        self._threads = []
+
+    def warm(self, db):
+        """ Update the indexes of <db>.
+
+            :returns: update sequence of the database the indexes include
+        """
+        since = db.info()['update_seq']
+        db.refresh_index()
+        return since
+
+    def _run(self, db):
+        since = None
+        while not self._stopped.is_set():
+            try:
+                if since is None:
+                    since = self.warm(db)
+                changes = db.changes(feed='longpoll', since=since, limit=1, timeout=self.poll_timeout)
+                if changes['results'] and not self._stopped.is_set():
+                    # Let the rest of the burst come in
+                    self._stopped.wait(self.window)
+                    since = self.warm(db)
+            except Exception as e:
+                log.warning("Failed to warm the indexes of {0}: {1}".format(db.name, e))
+                since = None
+                self._stopped.wait(RETRY_DELAY)
@@ -0,0 +1,196 @@
+"""
+ers.writebuffer
+
+Write-behind buffer for ERS: persisted entities are kept in memory and
+written to CouchDB in groups, with one _bulk_docs request per database.
+
+Successive writes of the same entity before a flush are merged into a
+single write of its latest state. The buffer is flushed when it holds
+max_entities entities, max_delay seconds after the oldest pending write,
+or when flush() is called.
+
+With the 'buffer' durability a write returns as soon as the entity is in
+the buffer, and is lost if the process dies before the next flush. With
+the 'commit' durability it returns once the group commit containing it
+has been written to CouchDB.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+DURABILITY_BUFFER = 'buffer'
+DURABILITY_COMMIT = 'commit'
+DURABILITIES = [DURABILITY_BUFFER, DURABILITY_COMMIT]
+
+DEFAULT_MAX_ENTITIES = 500
+DEFAULT_MAX_DELAY = 1.0
+
+log = logging.getLogger('ers')
+
+
+class WriteBufferError(Exception):
+    pass
+
+
+class WriteBuffer(object):
+    """ Buffer of documents waiting to be written.
+
+        :param save: function writing a list of (entity_name, scope, doc)
+            tuples and returning one (entity_name, scope, success, doc_id, rev)
+            tuple for each of them
+        :type save: callable
+        :param max_entities: number of buffered entities triggering a flush
+        :type max_entities: int
+        :param max_delay: maximum time in seconds a write stays in the buffer
+        :type max_delay: float
+        :param durability: 'buffer' or 'commit'
+        :type durability: str
+    """
+    def __init__(self, save, max_entities=DEFAULT_MAX_ENTITIES, max_delay=DEFAULT_MAX_DELAY,
+                 durability=DURABILITY_BUFFER):
+        if durability not in DURABILITIES:
+            raise ValueError("Unknown durability {0}, use one of {1}".format(durability, DURABILITIES))
+        self._save = save
+        self.max_entities = max_entities
+        self.max_delay = max_delay
+        self.durability = durability
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        # entity name -> scope -> (snapshot written at the next flush, document of the caller)
+        self._entries = OrderedDict()
+        self._oldest = None
+        self._generation = 0
+        self._committed = -1
+        self._failed = {}
+        # Latest revisions written, for snapshots taken while their previous version was being flushed
+        self._revs = OrderedDict()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, entity_name):
+        """ Get copies of the buffered documents of an entity, by scope, or
+            None if the entity has no pending write.
+        """
+        with self._cond:
+            entry = self._entries.get(entity_name)
+            if entry is None:
+                return None
+            return dict((scope, deepcopy(snapshot)) for scope, (snapshot, _) in entry.iteritems())
+
+    def discard(self, entity_name):
+        """ Drop the pending writes of an entity.
+        """
+        with self._cond:
+            self._entries.pop(entity_name, None)
+
+    def clear(self):
+        with self._cond:
+            self._entries.clear()
+            self._oldest = None
+
+    def add(self, entity_name, docs):
+        """ Buffer the documents of an entity.
+
+            :param docs: documents to write by scope, they must have an _id
+            :type docs: dict
+        """
+        entry = dict((scope, (deepcopy(doc), doc)) for scope, doc in docs.iteritems())
+        with self._cond:
+            if not self._entries:
+                self._oldest = time.time()
+            self._entries.setdefault(entity_name, {}).update(entry)
+            generation = self._generation
+            is_full = len(self._entries) >= self.max_entities
+            self._cond.notify_all()
+        self._start()
+
+        if is_full:
+            self.flush()
+
+        if self.durability == DURABILITY_COMMIT:
+            with self._cond:
+                while self._committed < generation:
+                    self._cond.wait()
+                failed = self._failed.get(generation, ())
+            if entity_name in failed:
+                raise WriteBufferError("Failed to write entity {0}".format(entity_name))
+
+    def flush(self):
+        """ Write all the buffered documents now.
+
+            :returns: one (entity_name, scope, success, doc_id, rev) tuple per document
+            :rtype: list
+        """
+        with self._flush_lock:
+            with self._cond:
+                entries = self._entries
+                self._entries = OrderedDict()
+                self._oldest = None
+                generation = self._generation
+                self._generation += 1
+
+            results = []
+            failed = set()
+            try:
+                items = []
+                callers_docs = []
+                for entity_name, scopes in entries.iteritems():
+                    for scope, (snapshot, doc) in scopes.iteritems():
+                        if snapshot['_id'] in self._revs:
+                            snapshot['_rev'] = self._revs[snapshot['_id']]
+                        items.append((entity_name, scope, snapshot))
+                        callers_docs.append(doc)
+                if items:
+                    results = self._save(items)
+
+                for doc, (entity_name, scope, success, doc_id, rev) in zip(callers_docs, results):
+                    if success:
+                        doc['_rev'] = rev
+                        self._revs.pop(doc_id, None)
+                        self._revs[doc_id] = rev
+                    else:
+                        failed.add(entity_name)
+                        log.warning("Write-behind failed for {0} ({1}): {2}".format(entity_name, scope, rev))
+                while len(self._revs) > 10 * self.max_entities:
+                    self._revs.popitem(last=False)
+            except Exception:
+                failed = set(entries.keys())
+                raise
+            finally:
+                with self._cond:
+                    self._committed = generation
+                    if failed:
+                        self._failed[generation] = failed
+                    self._failed.pop(generation - 10, None)
+                    self._cond.notify_all()
+            return results
+
+    def _start(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='ers-write-behind')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._oldest is None:
+                    self._cond.wait()
+                delay = self._oldest + self.max_delay - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("Write-behind flush failed: {0}".format(e))
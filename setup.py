@@ -8,5 +8,6 @@ setup(name='ERS',
       description='Entity Registry System',
       url='https://github.com/ers-devs/ers-node/',
       packages=['ers'],
+      scripts=['bin/ers-import'],
       requires = requirements
      )
@@ -2,6 +2,9 @@ from ers import store
 from couchdb.client import Database, Server
 
 from copy import deepcopy
+from mock import patch
+import threading
+import time
 import unittest
 
 class StorageTests(unittest.TestCase):
@@ -163,6 +166,157 @@ class StorageTests(unittest.TestCase):
 
 
 
+class ReplicaTests(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store()
+
+    def tearDown(self):
+        self.store.reset()
+
+    def testRecacheLeavesNoConflict(self):
+        public = self.store[store.ERS_PUBLIC_DB]
+        cache = self.store[store.ERS_CACHE_DB]
+        doc = {"@id": "urn:ers:a", "rdf:type": "ers:A"}
+        public.save(doc)
+        self.assertEqual(cache.save_replicas([deepcopy(doc)]), 1)
+        doc["rdf:type"] = "ers:B"
+        public.save(doc)
+        self.assertEqual(cache.save_replicas([deepcopy(doc)]), 1)
+
+        cached = cache.get(doc["_id"], conflicts=True)
+        self.assertEqual(cached["_rev"], doc["_rev"])
+        self.assertFalse("_conflicts" in cached)
+        # An older revision received later does not come back either
+        self.assertEqual(cache.save_replicas([dict(doc, _rev="1-" + "0" * 32)]), 1)
+        self.assertFalse("_conflicts" in cache.get(doc["_id"], conflicts=True))
+        self.assertEqual(cache[doc["_id"]]["rdf:type"], "ers:B")
+
+
+class BootstrapTests(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store()
+
+    def tearDown(self):
+        self.store.reset()
+
+    def testWarmStartSkipsRepair(self):
+        with patch.object(store.Store, '_repair') as repair:
+            store.Store()
+        self.assertFalse(repair.called)
+
+    def testOtherBackendTriggersRepair(self):
+        with patch.object(store.Store, '_repair') as repair:
+            store.Store(index_backend=store.INDEX_MANGO)
+        self.assertTrue(repair.called)
+
+    def testBackendOfTheStoreIsUsed(self):
+        self.store.reset()
+        self.store = store.Store(index_backend=store.INDEX_MANGO)
+        with patch.object(store.Store, '_repair') as repair:
+            self.assertEqual(store.Store().index_backend, store.INDEX_MANGO)
+        self.assertFalse(repair.called)
+
+    def testRepairOnMissingDatabase(self):
+        del self.store._server[store.ERS_PUBLIC_DB]
+        self.assertEqual(self.store[store.ERS_PUBLIC_DB].by_entity("urn:ers:a"), [])
+        self.assertTrue(store.ERS_PUBLIC_DB in self.store._server)
+
+    def testRepairOnWrites(self):
+        del self.store._server[store.ERS_PUBLIC_DB]
+        self.store[store.ERS_PUBLIC_DB].save({"@id": "urn:ers:a"})
+        self.assertTrue(self.store[store.ERS_PUBLIC_DB].entity_exist("urn:ers:a"))
+        del self.store._server[store.ERS_STATE_DB]
+        self.assertEqual(self.store[store.ERS_STATE_DB].local_state()['peers'], {})
+
+    def testConcurrentRepairsRunOnce(self):
+        with patch.object(store.Store, '_repair') as repair:
+            with self.store._repair_lock:
+                threads = [threading.Thread(target=self.store._on_missing) for _ in range(3)]
+                for thread in threads:
+                    thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(repair.call_count, 1)
+
+
+class IndexMigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store()
+        db = self.store[store.ERS_PUBLIC_DB]
+        db.update([{"@id": "urn:ers:a", "rdf:type": "ers:Test"}])
+        # Install an older version of the index and forget the checks
+        old_index = db[store.INDEX_DOC_ID]
+        old_index['version'] = store.INDEX_VERSION - 1
+        del old_index['views']['count_by_property_value']
+        db.save(old_index)
+        state_db = self.store[store.ERS_STATE_DB]
+        state_db.delete(state_db[store.SCHEMA_DOC_ID])
+
+    def tearDown(self):
+        self.store.reset()
+
+    def testIndexIsMigrated(self):
+        migrating = store.ServiceStore()
+        db = migrating[store.ERS_PUBLIC_DB]
+        # The old views answer until the migration is over, counts read their rows
+        self.assertEqual(db.by_property_value("rdf:type", "ers:Test"), ["urn:ers:a"])
+        self.assertEqual(db.count_by_property_value("rdf:type"), 1)
+        self.assertEqual(db.facets_by_property("rdf:type"), {"ers:Test": 1})
+        migrating.wait_for_migration()
+
+        self.assertEqual(db[store.INDEX_DOC_ID]['version'], store.INDEX_VERSION)
+        self.assertFalse(store.STAGING_DOC_ID in db)
+        self.assertEqual(db.count_by_property_value("rdf:type"), 1)
+        # Peers query by_property_value without reduce=false, it stays map-only
+        rows = db.view('index/by_property_value', key=["rdf:type", "ers:Test"]).rows
+        self.assertEqual([r['value'] for r in rows], ["urn:ers:a"])
+        marker = migrating[store.ERS_STATE_DB][store.SCHEMA_DOC_ID]
+        self.assertFalse('outdated' in marker)
+
+    def testOnlyTheDaemonMigrates(self):
+        client = store.Store()
+        self.assertEqual(client[store.ERS_PUBLIC_DB][store.INDEX_DOC_ID]['version'], store.INDEX_VERSION - 1)
+        self.assertTrue(client[store.ERS_STATE_DB][store.SCHEMA_DOC_ID]['outdated'])
+        # The other clients do not check the store again
+        with patch.object(store.Store, '_repair') as repair:
+            store.Store()
+        self.assertFalse(repair.called)
+        # The daemon always does, and migrates the indexes
+        with patch('ers.store.migrate_index') as migrate:
+            store.ServiceStore().wait_for_migration()
+        self.assertEqual(migrate.call_count, 1)
+
+
+class MangoIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(index_backend=store.INDEX_MANGO)
+        self.db = self.store[store.ERS_PUBLIC_DB]
+        self.db.update([{"@id": "urn:ers:a", "rdf:type": "ers:Test"},
+                        {"@id": "urn:ers:a", "rdfs:label": "A"},
+                        {"@id": "urn:ers:b", "rdf:type": "ers:Test"},
+                        {"no-entity": True}])
+        self.views = store.ERSDatabase(self.db)
+        self.views.index_backend = store.INDEX_JAVASCRIPT
+
+    def tearDown(self):
+        self.store.reset()
+
+    def testDocsByEntity(self):
+        self.assertEqual(sorted(d['_id'] for d in self.db.docs_by_entity("urn:ers:a")),
+                         sorted(d['_id'] for d in self.views.docs_by_entity("urn:ers:a")))
+        self.assertEqual(sorted((k, d['_id']) for k, d in self.db.docs_by_entities(["urn:ers:a", "urn:ers:b"])),
+                         sorted((k, d['_id']) for k, d in self.views.docs_by_entities(["urn:ers:a", "urn:ers:b"])))
+
+    def testEntityRows(self):
+        rows = lambda db: sorted((r['id'], r['key'], r['value']['rev']) for r in db.by_entity("urn:ers:a"))
+        self.assertEqual(rows(self.db), rows(self.views))
+        self.assertEqual(sorted(self.db.entity_ids()), sorted(self.views.entity_ids()))
+        self.assertTrue(self.db.entity_exist("urn:ers:b"))
+        self.assertFalse(self.db.entity_exist("urn:ers:c"))
+
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,82 @@
+"""
+Compare the storage engines of the local store, CouchDB (ers.store) and
+SQLite (ers.sqlitestore), on persisting entities one at a time and in
+bulk, getting entities and searching by property value.
+
+The CouchDB runs need a running CouchDB; its ERS databases and the SQLite
+files (in a temporary directory) are reset before and after.
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from ers import ERS
+from ers.api import Entity
+from ers.store import STORAGES, STORAGE_SQLITE
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--entities", help="number of entities to persist", type=int, default=2000)
+parser.add_argument("-n", "--operations", help="number of gets and searches", type=int, default=500)
+parser.add_argument("-s", "--storages", help="storage engines to compare", nargs='+',
+                    default=STORAGES, choices=STORAGES)
+args = parser.parse_args()
+
+TYPES = ['ers:Type' + str(i) for i in range(20)]
+
+
+def make_entity(entity_name):
+    entity = Entity(entity_name)
+    entity.add('rdf:type', random.choice(TYPES))
+    entity.add('rdfs:label', 'label of ' + entity_name)
+    entity.add('ers:note', 'private note', True)
+    return entity
+
+
+def timed(function, items):
+    latencies = []
+    for item in items:
+        start = time.time()
+        function(item)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+
+def report(storage, label, latencies):
+    print "{0:<8} {1:<16} mean {2:7.2f} ms   median {3:7.2f} ms   p95 {4:7.2f} ms".format(
+        storage, label,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)])
+
+
+def run(storage, path):
+    ers = ERS(local_only=True, storage=storage, storage_path=path)
+    ers.reset()
+
+    names = ['urn:ers:benchmark:' + str(uuid.uuid4()) for _ in xrange(args.entities)]
+    half = len(names) // 2
+    report(storage, "persist_entity", timed(lambda name: ers.persist_entity(make_entity(name)), names[:half]))
+
+    start = time.time()
+    ers.persist_entities([make_entity(name) for name in names[half:]])
+    elapsed = time.time() - start
+    print "{0:<8} {1:<16} {2:7.0f} entities/s".format(storage, "persist_entities", (len(names) - half) / elapsed)
+
+    sample = [random.choice(names) for _ in xrange(args.operations)]
+    report(storage, "get", timed(lambda name: ers.get(name, include_remote=False), sample))
+    report(storage, "search", timed(lambda value: ers.search('rdf:type', value, include_remote=False),
+                                    [random.choice(TYPES) for _ in xrange(args.operations)]))
+    ers.reset()
+
+
+path = tempfile.mkdtemp()
+print "{0} entities, {1} gets and searches".format(args.entities, args.operations)
+try:
+    for storage in args.storages:
+        run(storage, path if storage == STORAGE_SQLITE else None)
+finally:
+    shutil.rmtree(path)
@@ -0,0 +1,60 @@
+"""
+Measure the latency of the local part of ERS.get, querying the public,
+private and cache databases one after the other (as ERS.get used to) or
+concurrently through Store.docs_by_entity.
+
+Needs a running CouchDB; the ERS databases are reset before and after.
+"""
+import argparse
+import time
+import uuid
+
+from ers import ERS
+from ers.store import ERS_PUBLIC_DB, ERS_PRIVATE_DB, ERS_CACHE_DB
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-e", "--entities", help="number of entities to load", type=int, default=100)
+parser.add_argument("-n", "--gets", help="number of gets per run", type=int, default=500)
+args = parser.parse_args()
+
+
+def sequential_get(store, entity_name):
+    return dict((source, store[db_name].docs_by_entity(entity_name))
+                for source, db_name in store.db_names.iteritems())
+
+
+def concurrent_get(store, entity_name):
+    return store.docs_by_entity(entity_name)
+
+
+def run(label, get, store, entities):
+    latencies = []
+    for i in xrange(args.gets):
+        entity_name = entities[i % len(entities)]
+        start = time.time()
+        get(store, entity_name)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    print "{0:<12} mean {1:7.2f} ms   median {2:7.2f} ms   p95 {3:7.2f} ms".format(
+        label,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)])
+
+
+ers = ERS(local_only=True)
+ers.reset()
+
+entities = ['urn:ers:benchmark:' + str(uuid.uuid4()) for _ in xrange(args.entities)]
+for entity_name in entities:
+    for db_name in (ERS_PUBLIC_DB, ERS_PRIVATE_DB, ERS_CACHE_DB):
+        ers.store[db_name].save({'@id': entity_name, 'rdf:type': 'ers:Benchmark'})
+
+# Build the indexes before measuring
+sequential_get(ers.store, entities[0])
+
+print "Per-get latency over {0} gets of {1} entities".format(args.gets, args.entities)
+run("sequential", sequential_get, ers.store, entities)
+run("concurrent", concurrent_get, ers.store, entities)
+
+ers.reset()
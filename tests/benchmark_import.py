@@ -0,0 +1,64 @@
+"""
+Throughput of the streaming N-Triples importer (ers.utils.import_nt) on
+tests/data/repo10k.nt, compared with writing the entities one
+persist_entity call at a time, and of the parallel importer
+(ers.utils.import_nt_parallel) with an increasing number of processes.
+
+Needs a running CouchDB; the ERS databases are reset before and after.
+"""
+import argparse
+import os
+import time
+
+from ers import ERS
+from ers.utils import import_nt, import_nt_parallel, iter_nt, group_by_subject, DEFAULT_CHUNK_SIZE
+
+TESTS_PATH = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-f", "--file", help="N-Triples file to import",
+                    default=os.path.join(TESTS_PATH, 'data', 'repo10k.nt'))
+parser.add_argument("-c", "--chunk-size", help="number of entities per bulk write",
+                    type=int, default=DEFAULT_CHUNK_SIZE)
+parser.add_argument("-j", "--processes", help="numbers of processes of the parallel runs",
+                    type=int, nargs='*', default=[2, 4, 8])
+args = parser.parse_args()
+
+
+def per_entity_import(ers, file_name):
+    statements = 0
+    with open(file_name, 'r') as lines:
+        for subject, properties in group_by_subject(iter_nt(lines)):
+            entity = ers.get(subject, include_remote=False)
+            for p, o in properties:
+                entity.add(p, o)
+            ers.persist_entity(entity)
+            statements += len(properties)
+    return statements
+
+
+def report(label, statements, elapsed):
+    print "{0:<13} {1:7d} statements in {2:7.2f} s   {3:9.1f} statements/s".format(
+        label, statements, elapsed, statements / elapsed)
+
+
+ers = ERS(local_only=True)
+ers.reset()
+
+start = time.time()
+statements = per_entity_import(ers, args.file)
+report("per-entity", statements, time.time() - start)
+
+ers.reset()
+
+start = time.time()
+stats = import_nt(ers, args.file, chunk_size=args.chunk_size)
+report("streaming", stats['statements'], time.time() - start)
+
+for processes in args.processes:
+    ers.reset()
+    start = time.time()
+    stats = import_nt_parallel(ers, args.file, processes, chunk_size=args.chunk_size)
+    report("{0} processes".format(processes), stats['statements'], time.time() - start)
+
+ers.reset()
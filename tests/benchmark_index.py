@@ -0,0 +1,80 @@
+"""
+Index build time and entity lookup latency of the index backends of the
+local store (JavaScript views, Erlang views, Mango index on @id) on
+databases of 10k, 100k and 1M documents.
+
+The erlang backend needs the native query server enabled in CouchDB, the
+mango backend CouchDB 2.0 or later; unavailable backends are reported as
+such. Needs a running CouchDB; the ERS databases are reset before and after.
+"""
+import argparse
+import random
+import time
+import uuid
+
+from ers.store import Store, ERS_PUBLIC_DB, INDEX_BACKENDS, INDEX_MANGO
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--sizes", help="numbers of documents", type=int, nargs='+',
+                    default=[10000, 100000, 1000000])
+parser.add_argument("-b", "--backends", help="index backends to compare", nargs='+',
+                    default=INDEX_BACKENDS, choices=INDEX_BACKENDS)
+parser.add_argument("-n", "--lookups", help="number of entity lookups", type=int, default=500)
+args = parser.parse_args()
+
+BATCH_SIZE = 1000
+
+
+def load(db, size):
+    entities = []
+    for i in xrange(0, size, BATCH_SIZE):
+        docs = []
+        for _ in xrange(min(BATCH_SIZE, size - i)):
+            entity_name = 'urn:ers:benchmark:' + str(uuid.uuid4())
+            entities.append(entity_name)
+            docs.append({'@id': entity_name,
+                         'rdf:type': 'ers:Benchmark',
+                         'rdfs:label': ['label ' + str(random.random()), 'label ' + str(i)]})
+        db.update(docs)
+    return entities
+
+
+def build(db, backend):
+    """ Time the build of all the indexes the backend keeps: the views of the
+        index design document (built together) and, for mango, the @id index.
+    """
+    start = time.time()
+    db.view('index/by_entity', limit=1).rows
+    if backend == INDEX_MANGO:
+        db.entity_exist('urn:ers:benchmark:none')
+    return time.time() - start
+
+
+def lookups(db, entities):
+    latencies = []
+    for _ in xrange(args.lookups):
+        entity_name = random.choice(entities)
+        start = time.time()
+        db.docs_by_entity(entity_name)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+
+print "{0:>8} {1:<11} {2:>10} {3:>12} {4:>12}".format("docs", "backend", "build (s)", "median (ms)", "p95 (ms)")
+for size in args.sizes:
+    for backend in args.backends:
+        try:
+            store = Store(index_backend=backend)
+            store.reset()
+            db = store[ERS_PUBLIC_DB]
+            entities = load(db, size)
+            build_time = build(db, backend)
+            median, p95 = lookups(db, entities)
+        except Exception as e:
+            print "{0:>8} {1:<11} unavailable: {2}".format(size, backend, e)
+            continue
+        print "{0:>8} {1:<11} {2:10.2f} {3:12.2f} {4:12.2f}".format(
+            size, backend, build_time, 1000 * median, 1000 * p95)
+
+Store().reset()
@@ -0,0 +1,48 @@
+"""
+Compare the write throughput of ERS.persist_entity (one save per document)
+with ERS.persist_entities (_bulk_docs per chunk of entities).
+
+Needs a running CouchDB; the ERS databases are reset before and after.
+Replication updates are not sent to the daemon during the measurement.
+"""
+import argparse
+import time
+import uuid
+
+from mock import patch
+
+from ers import ERS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--entities", help="number of entities to write per run", type=int, default=2000)
+parser.add_argument("-p", "--properties", help="properties per entity", type=int, default=5)
+parser.add_argument("-c", "--chunk_size", help="entities per _bulk_docs request", type=int, default=500)
+args = parser.parse_args()
+
+
+def make_entities(ers):
+    entities = []
+    for _ in xrange(args.entities):
+        entity = ers.get('urn:ers:benchmark:' + str(uuid.uuid4()), include_remote=False)
+        for i in xrange(args.properties):
+            entity.add('urn:ers:benchmark:property:' + str(i), str(uuid.uuid4()))
+        entities.append(entity)
+    return entities
+
+
+def run(label, write, entities):
+    start = time.time()
+    write(entities)
+    elapsed = time.time() - start
+    print "{0:<18} {1:6d} docs in {2:7.2f} s   {3:9.1f} docs/s".format(
+        label, len(entities), elapsed, len(entities) / elapsed)
+
+
+ers = ERS(local_only=True)
+ers.reset()
+
+with patch.object(ERS, 'trigger_replication_update'):
+    run("persist_entity", lambda entities: [ers.persist_entity(e) for e in entities], make_entities(ers))
+    run("persist_entities", lambda entities: ers.persist_entities(entities, args.chunk_size), make_entities(ers))
+
+ers.reset()
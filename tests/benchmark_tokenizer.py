@@ -0,0 +1,74 @@
+"""
+Throughput of the N-Triples tokenizer (ers.utils.tokenize_nt) compared with
+the whitespace-splitting parser EntityCache.parse_nt used to have and with
+rdflib (EntityCache.parse_nt_rdflib).
+
+Does not need CouchDB.
+"""
+import argparse
+import os
+import time
+
+from ers.utils import tokenize_nt, EntityCache
+
+TESTS_PATH = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-f", "--file", help="N-Triples file to parse",
+                    default=os.path.join(TESTS_PATH, 'data', 'repo10k.nt'))
+parser.add_argument("-r", "--runs", help="number of runs, the best one is reported", type=int, default=5)
+args = parser.parse_args()
+
+
+def iter_split(file_name):
+    """ The former EntityCache.parse_nt, which mangles escaped quotes and
+        drops datatypes, language tags and blank nodes.
+    """
+    for input_line in open(file_name, 'r'):
+        triple = input_line.split(None, 2)
+        s = triple[0][1:-1]
+        p = triple[1][1:-1]
+        oquote = triple[2][0]
+        if oquote == '"':
+            o = triple[2][1:].rsplit('"')[0]
+        elif oquote == '<':
+            o = triple[2][1:].rsplit('>')[0]
+        else:
+            o = triple[2].split(' ')[0]
+        yield (s, p, o)
+
+
+def split_parser(file_name):
+    count = 0
+    for _ in iter_split(file_name):
+        count += 1
+    return count
+
+
+def tokenizer(file_name):
+    count = 0
+    with open(file_name, 'r') as source:
+        for _ in tokenize_nt(source):
+            count += 1
+    return count
+
+
+def rdflib_parser(file_name):
+    cache = EntityCache().parse_nt_rdflib(filename=file_name)
+    return sum(len(objects) for properties in cache.itervalues() for objects in properties.itervalues())
+
+
+def run(label, parse):
+    best = None
+    for _ in xrange(args.runs):
+        start = time.time()
+        count = parse(args.file)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "{0:<10} {1:7d} triples in {2:7.3f} s   {3:10.0f} triples/s".format(
+        label, count, best, count / best)
+
+
+run("split", split_parser)
+run("tokenizer", tokenizer)
+run("rdflib", rdflib_parser)
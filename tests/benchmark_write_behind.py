@@ -0,0 +1,46 @@
+"""
+Append-heavy write benchmark: statements are added one at a time to a few
+entities, each followed by persist_entity, as a sensor writer would do.
+Compares direct writes with the write-behind buffer.
+
+Needs a running CouchDB; the ERS databases are reset before and after.
+"""
+import argparse
+import random
+import time
+import uuid
+
+from mock import patch
+
+from ers import ERS
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--statements", help="number of statements written per run", type=int, default=2000)
+parser.add_argument("-e", "--entities", help="number of entities written to", type=int, default=20)
+parser.add_argument("-d", "--durability", help="durability of the write-behind run", default='buffer',
+                    choices=['buffer', 'commit'])
+args = parser.parse_args()
+
+
+def run(label, ers):
+    entities = ['urn:ers:benchmark:' + str(uuid.uuid4()) for _ in xrange(args.entities)]
+    start = time.time()
+    for _ in xrange(args.statements):
+        entity = ers.get(random.choice(entities), include_remote=False)
+        entity.add('urn:ers:benchmark:property', str(uuid.uuid4()))
+        ers.persist_entity(entity)
+    ers.flush()
+    elapsed = time.time() - start
+    print "{0:<14} {1:6d} statements in {2:7.2f} s   {3:9.1f} statements/s".format(
+        label, args.statements, elapsed, args.statements / elapsed)
+
+
+with patch.object(ERS, 'trigger_replication_update'):
+    direct = ERS(local_only=True)
+    direct.reset()
+    run("direct", direct)
+
+    buffered = ERS(local_only=True, write_behind=True, durability=args.durability)
+    run("write-behind", buffered)
+
+    buffered.reset()
@@ -11,16 +11,18 @@ from ers.utils import import_nt, import_nt_rdflib
 nt_file = os.path.join(TESTS_PATH, 'data', 'timbl.nt')
 
 def test(keep_db=False):
-    dbname = 'ers_test_utils'
-    ers = ERS(dbname=dbname, reset_database=True)
-    import_nt(ers, nt_file, 'timbl')
-    assert ers.exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/006251587X', 'timbl') == True
-    import_nt_rdflib(ers, nt_file, 'timbl2')
-    assert ers.exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/006251587X', 'timbl2') == True
-    assert ers.exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/006251587X', 'timbl3') == False
+    ers = ERS(local_only=True)
+    ers.reset()
+    stats = import_nt(ers, nt_file)
+    assert stats['failures'] == 0
+    assert ers.entity_exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/006251587X') == True
+    ers.reset()
+    import_nt_rdflib(ers, nt_file)
+    assert ers.entity_exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/006251587X') == True
+    assert ers.entity_exist('http://www4.wiwiss.fu-berlin.de/booksMeshup/books/missing') == False
     print "Tests pass"
     if not keep_db:
-        ers.db.server.delete_db(dbname)
+        ers.reset()
 
 if __name__ == '__main__':
     test()
@@ -1,9 +1,28 @@
 from ers import ERS
-from ers import store
+from ers import store, utils
+from ers.api import Entity
+from ers.health import PeerHealth, CLOSED, OPEN, HALF_OPEN
+from ers.lru import EntityLRU, signature
+from ers.notifier import ReplicationNotifier
+from ers.warmer import IndexWarmer
+from ers.sqlitestore import SQLiteDatabase, SQLiteStore
+from ers.writebuffer import WriteBuffer, DURABILITY_COMMIT
+from ers.utils import iter_nt, tokenize_nt, group_by_subject, load_entities, NTriplesSyntaxError
+from ers.utils import import_nt, import_nt_parallel, import_document_id, split_lines
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from mock import patch
+import uuid
+from copy import deepcopy
+from mock import patch, MagicMock
+from rdflib import URIRef
 
 TEST_ENTITY = "urn:ers:test"
+FAST_PEER = "http://192.0.2.1:5984/"
+SLOW_PEER = "http://192.0.2.2:5984/"
 
 class APITestCase(unittest.TestCase):
     """
@@ -191,6 +210,651 @@ class APITestCase(unittest.TestCase):
         list_of_entities = self.ers.search(predicate, value)
         self.assertEqual(len(list_of_entities), 10)
 
+    @patch('ers.ERS.trigger_replication_update')
+    def testGetMany(self, repl_update):
+        predicate = "rdf:type"
+        value = "ers:TestCase"
+        names = [TEST_ENTITY + str(i) for i in range(3)]
+        for entity_name in names:
+            entity = self.ers.get(entity_name)
+            entity.add(predicate, value)
+            self.ers.persist_entity(entity)
+
+        entities = self.ers.get_many(names + ["urn:ers:missing"], include_remote=False)
+        self.assertEqual(sorted(entities.keys()), sorted(names + ["urn:ers:missing"]))
+        for entity_name in names:
+            self.assertEqual(entities[entity_name].to_tuples(), [(predicate, value, 'public')])
+        self.assertEqual(entities["urn:ers:missing"].to_tuples(), [])
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testSearchPages(self, repl_update):
+        predicate = "rdf:type"
+        value = "ers:TestCase"
+        names = [TEST_ENTITY + str(i) for i in range(5)]
+        for entity_name in names:
+            entity = self.ers.get(entity_name)
+            entity.add(predicate, value)
+            self.ers.persist_entity(entity)
+
+        results = []
+        pages = 0
+        cursor = None
+        while True:
+            page, cursor = self.ers.search_page(predicate, value, limit=2, cursor=cursor)
+            self.assertTrue(len(page) <= 2)
+            results.extend(page)
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEqual(sorted(results), sorted(names))
+        self.assertEqual(pages, 3)
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testCountAndFacets(self, repl_update):
+        predicate = "rdf:type"
+        for i, value in enumerate(["ers:A", "ers:B", "ers:A", "ers:C", "ers:A"]):
+            entity = self.ers.get(TEST_ENTITY + str(i))
+            entity.add(predicate, value)
+            if i == 3:
+                entity.add(predicate, "ers:B")
+            self.ers.persist_entity(entity)
+
+        self.assertEqual(self.ers.count(predicate), 6)
+        self.assertEqual(self.ers.count(predicate, "ers:A"), 3)
+        self.assertEqual(self.ers.count(predicate, "ers:Z"), 0)
+        self.assertEqual(self.ers.facets(predicate), [("ers:A", 3), ("ers:B", 2), ("ers:C", 1)])
+        self.assertEqual(self.ers.facets(predicate, limit=1), [("ers:A", 3)])
+        self.assertEqual(sorted(self.ers.search(predicate, "ers:B")), [TEST_ENTITY + "1", TEST_ENTITY + "3"])
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testPrefixAndRangeSearch(self, repl_update):
+        predicate = "rdfs:label"
+        for i, value in enumerate(["alpha", "alpine", "beta", "alp*"]):
+            entity = self.ers.get(TEST_ENTITY + str(i))
+            entity.add(predicate, value)
+            self.ers.persist_entity(entity)
+
+        self.assertEqual(sorted(self.ers.search(predicate, "alp*")),
+                         [TEST_ENTITY + "0", TEST_ENTITY + "1", TEST_ENTITY + "3"])
+        self.assertEqual(self.ers.search(predicate, "alp\\*"), [TEST_ENTITY + "3"])
+        self.assertEqual(self.ers.search_range(predicate, "b", "c"), [TEST_ENTITY + "2"])
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testPersistEntities(self, repl_update):
+        entities = []
+        for i in range(5):
+            entity = self.ers.get(TEST_ENTITY + str(i))
+            entity.add("rdf:type", "ers:TestCase")
+            entity.add("rdf:type", "ers:Secret", private=True)
+            entities.append(entity)
+
+        results = self.ers.persist_entities(entities, chunk_size=2)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(success for _, _, success, _, _ in results))
+        self.assertEqual(repl_update.call_count, 0)
+        self.ers.update_replication_on_persist = True
+        self.ers.persist_entities(entities[1:3])
+        self.assertEqual(repl_update.call_count, 1)
+        self.assertEqual(len(self.ers.search("rdf:type", "ers:TestCase")), 5)
+
+        # Saving the same documents again with stale revisions conflicts
+        for entity in entities:
+            entity.get_documents('public').to_json()['_rev'] = '1-0'
+        results = self.ers.persist_entities(entities[:1])
+        self.assertEqual(sorted((scope, success) for _, scope, success, _, _ in results),
+                         [('private', True), ('public', False)])
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testDeleteMany(self, repl_update):
+        entities = []
+        for i in range(5):
+            entity = self.ers.get(TEST_ENTITY + str(i))
+            entity.add("rdf:type", "ers:TestCase")
+            entity.add("rdf:type", "ers:Secret", private=True)
+            entities.append(entity)
+        self.ers.persist_entities(entities)
+
+        names = [TEST_ENTITY + str(i) for i in range(4)]
+        self.assertTrue(self.ers.delete_many(names + [TEST_ENTITY + 'missing'], chunk_size=3))
+        for name in names:
+            self.assertFalse(self.ers.entity_exist(name))
+        self.assertTrue(self.ers.entity_exist(TEST_ENTITY + '4'))
+
+        # Tombstones keep the entity name for filtered replication
+        changes = self.ers.store[store.ERS_PUBLIC_DB].changes(include_docs=True)['results']
+        tombstones = [c['doc'] for c in changes if c.get('deleted')]
+        self.assertEqual(sorted(doc['@id'] for doc in tombstones), names)
+
+    @patch('ers.ERS.trigger_replication_update')
+    def testCacheEntities(self, repl_update):
+        entities = []
+        for i in range(3):
+            entity = self.ers.get(TEST_ENTITY + str(i), include_remote=False)
+            entity.add_document({'_id': 'remote-doc-' + str(i), '_rev': '3-abc' + str(i),
+                                 '@id': TEST_ENTITY + str(i), 'rdf:type': 'ers:TestCase'}, 'remote')
+            entities.append(entity)
+
+        self.assertEqual(self.ers.cache_entities(entities), 3)
+        self.assertEqual(repl_update.call_count, 1)
+        cache = self.ers.store[store.ERS_CACHE_DB]
+        self.assertEqual(cache['remote-doc-0']['_rev'], '3-abc0')
+        for i in range(3):
+            self.assertTrue(self.ers.is_cached(TEST_ENTITY + str(i)))
+
+        # Documents already cached at the same revision are not written again
+        self.assertEqual(self.ers.cache_entities(entities), 0)
+        self.assertEqual(repl_update.call_count, 1)
+
+    @patch('ers.store.query_remote')
+    def testGetSkipsSlowPeer(self, query_remote):
+        release = threading.Event()
+        def fake_query(url, method_name, *args):
+            if url == SLOW_PEER:
+                release.wait()
+            return [{'@id': TEST_ENTITY, 'rdf:type': 'ers:Remote'}]
+        query_remote.side_effect = fake_query
+
+        peers = [{'server_url': FAST_PEER}, {'server_url': SLOW_PEER}]
+        self.ers.remote_deadline = 0.2
+        with patch.object(self.ers, 'get_peers', return_value=peers):
+            entity = self.ers.get(TEST_ENTITY)
+        release.set()
+
+        self.assertEqual(len(entity.get_documents('remote')), 1)
+        self.assertEqual(entity.get_unresponsive_peers(), [SLOW_PEER])
+
+    @patch('ers.store.query_remote')
+    def testIterSearchDoesNotWaitForSlowPeer(self, query_remote):
+        release = threading.Event()
+        def fake_query(url, method_name, *args):
+            if url == SLOW_PEER:
+                release.wait()
+                return [TEST_ENTITY, "urn:ers:slow"]
+            return [TEST_ENTITY, "urn:ers:fast"]
+        query_remote.side_effect = fake_query
+
+        peers = [{'server_url': FAST_PEER}, {'server_url': SLOW_PEER}]
+        with patch.object(self.ers, 'get_peers', return_value=peers):
+            results = self.ers.iter_search("rdf:type", "ers:Remote")
+            self.assertEqual(next(results), TEST_ENTITY)
+            self.assertEqual(next(results), "urn:ers:fast")
+            release.set()
+            self.assertEqual(list(results), ["urn:ers:slow"])
+
+    def testPeerListIsCached(self):
+        with patch.object(self.ers, '_refresh_peers', wraps=self.ers._refresh_peers) as refresh:
+            self.ers.get_peers()
+            self.ers.get_peers()
+            self.assertEqual(refresh.call_count, 1)
+
+            self.ers.invalidate_peers()
+            self.ers.get_peers()
+            self.assertEqual(refresh.call_count, 2)
+
+
+class PeerHealthTestCase(unittest.TestCase):
+    def testFailuresOpenCircuit(self):
+        health = PeerHealth(min_samples=3)
+        for i in range(3):
+            self.assertTrue(health.allow(SLOW_PEER))
+            health.record_failure(SLOW_PEER)
+        self.assertFalse(health.allow(SLOW_PEER))
+        self.assertEqual(health.state()[SLOW_PEER]['state'], OPEN)
+
+    def testHalfOpenLetsOneProbeThrough(self):
+        health = PeerHealth(min_samples=3, open_timeout=0)
+        for i in range(3):
+            health.record_failure(SLOW_PEER)
+        self.assertTrue(health.allow(SLOW_PEER))
+        self.assertEqual(health.state()[SLOW_PEER]['state'], HALF_OPEN)
+        self.assertFalse(health.allow(SLOW_PEER))
+
+        health.record_success(SLOW_PEER, 0.01)
+        self.assertEqual(health.state()[SLOW_PEER]['state'], CLOSED)
+        self.assertTrue(health.allow(SLOW_PEER))
+
+    def testSlowAnswersCountAsErrors(self):
+        health = PeerHealth(min_samples=3, slow_threshold=0.5)
+        for i in range(3):
+            health.record_success(SLOW_PEER, 2.0)
+        self.assertFalse(health.allow(SLOW_PEER))
+
+    def testOrderByLatency(self):
+        health = PeerHealth()
+        health.record_success(SLOW_PEER, 0.8)
+        health.record_success(FAST_PEER, 0.05)
+        self.assertEqual(health.order([SLOW_PEER, FAST_PEER]), [FAST_PEER, SLOW_PEER])
+
+
+class EntityLRUTestCase(unittest.TestCase):
+    def docs(self, rev):
+        return {'public': [{'_id': 'doc1', '_rev': rev, '@id': TEST_ENTITY}],
+                'private': [], 'cache': []}
+
+    def rows(self, rev):
+        return {'public': [{'id': 'doc1', 'key': TEST_ENTITY, 'value': {'rev': rev}}],
+                'private': [], 'cache': []}
+
+    def testHitOnSameRevisions(self):
+        cache = EntityLRU()
+        cache.put(TEST_ENTITY, self.docs('1-a'))
+        docs = cache.get(TEST_ENTITY, signature(self.rows('1-a')))
+        self.assertEqual(docs, self.docs('1-a'))
+
+        # Callers get their own copy
+        docs['public'][0]['rdf:type'] = 'ers:Changed'
+        self.assertEqual(cache.get(TEST_ENTITY, signature(self.rows('1-a'))), self.docs('1-a'))
+
+    def testMissOnNewRevision(self):
+        cache = EntityLRU()
+        cache.put(TEST_ENTITY, self.docs('1-a'))
+        self.assertEqual(cache.get(TEST_ENTITY, signature(self.rows('2-b'))), None)
+        self.assertEqual(len(cache), 0)
+
+    def testEviction(self):
+        cache = EntityLRU(max_entries=2)
+        for i in range(3):
+            cache.put(TEST_ENTITY + str(i), self.docs('1-a'))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(TEST_ENTITY + '0', signature(self.rows('1-a'))), None)
+
+        cache = EntityLRU(max_bytes=cache.size() // 2 + 1)
+        for i in range(3):
+            cache.put(TEST_ENTITY + str(i), self.docs('1-a'))
+        self.assertEqual(len(cache), 1)
+
+
+class ReplicationNotifierTestCase(unittest.TestCase):
+    @patch('ers.notifier.requests.get')
+    def testNotificationsAreCoalesced(self, get):
+        notifier = ReplicationNotifier('http://localhost/ReplicationLinksUpdate', window=0.1)
+        for i in range(5):
+            notifier.notify()
+        self.assertEqual(get.call_count, 0)
+        time.sleep(0.3)
+        self.assertEqual(get.call_count, 1)
+
+
+class IndexWarmerTestCase(unittest.TestCase):
+    def testIndexIsRefreshedAfterChanges(self):
+        db = MagicMock()
+        db.name = store.ERS_PUBLIC_DB
+        db.info.side_effect = [{'update_seq': 1}, {'update_seq': 3}, {'update_seq': 3}]
+        feed = [{'results': [{'seq': 2}], 'last_seq': 2}]
+        db.changes.side_effect = lambda **opts: feed.pop(0) if feed else time.sleep(0.1) or {'results': [], 'last_seq': opts['since']}
+        warmer = IndexWarmer([db], window=0.05)
+        warmer.start()
+        time.sleep(0.3)
+        warmer.stop()
+        self.assertEqual(db.refresh_index.call_count, 2)
+        self.assertEqual(db.changes.call_args_list[0][1]['since'], 1)
+        self.assertEqual(db.changes.call_args_list[-1][1]['since'], 3)
+
+
+class WriteBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+
+    def save(self, items):
+        self.saved.append([(entity_name, scope, dict(doc)) for entity_name, scope, doc in items])
+        return [(entity_name, scope, True, doc['_id'], '2-b') for entity_name, scope, doc in items]
+
+    def testWritesOfAnEntityAreMerged(self):
+        buf = WriteBuffer(self.save, max_delay=60)
+        doc = {'_id': 'doc1', '@id': TEST_ENTITY, 'rdf:type': 'ers:A'}
+        buf.add(TEST_ENTITY, {'public': doc})
+        doc['rdf:type'] = ['ers:A', 'ers:B']
+        buf.add(TEST_ENTITY, {'public': doc})
+        self.assertEqual(buf.get(TEST_ENTITY)['public']['rdf:type'], ['ers:A', 'ers:B'])
+        self.assertEqual(self.saved, [])
+
+        buf.flush()
+        self.assertEqual(len(self.saved), 1)
+        self.assertEqual(len(self.saved[0]), 1)
+        self.assertEqual(self.saved[0][0][2]['rdf:type'], ['ers:A', 'ers:B'])
+        # The caller's document knows its new revision
+        self.assertEqual(doc['_rev'], '2-b')
+        self.assertEqual(buf.get(TEST_ENTITY), None)
+
+    def testFlushWhenFull(self):
+        buf = WriteBuffer(self.save, max_entities=3, max_delay=60)
+        for i in range(7):
+            buf.add(TEST_ENTITY + str(i), {'public': {'_id': 'doc' + str(i)}})
+        self.assertEqual([len(group) for group in self.saved], [3, 3])
+        self.assertEqual(len(buf), 1)
+
+    def testFlushAfterDelay(self):
+        buf = WriteBuffer(self.save, max_delay=0.1)
+        buf.add(TEST_ENTITY, {'public': {'_id': 'doc1'}})
+        time.sleep(0.3)
+        self.assertEqual(len(self.saved), 1)
+
+    def testCommitDurabilityWaitsForTheWrite(self):
+        buf = WriteBuffer(self.save, max_delay=0.1, durability=DURABILITY_COMMIT)
+        buf.add(TEST_ENTITY, {'public': {'_id': 'doc1'}})
+        self.assertEqual(len(self.saved), 1)
+
+
+
+NT_DATA = """<urn:ers:a> <urn:ers:p> "one" .
+<urn:ers:a> <urn:ers:p> <urn:ers:b> .
+
+# comment
+<urn:ers:b> <urn:ers:q> "two" .
+<urn:ers:a> <urn:ers:q> "three" .
+"""
+
+class MemoryRegistry(object):
+    """ Stand-in for ERS in import tests, keeping documents in memory.
+    """
+    def __init__(self, *args, **kwargs):
+        self.host_urn = 'urn:ers:host:test'
+        self.store_options = kwargs
+        self.docs = {}
+        self.state = {}
+        self.store = {store.ERS_STATE_DB: self}
+        self.writes = 0
+        self.fail_at_write = None
+
+    def get_many(self, entity_names, include_remote=True):
+        entities = dict((name, Entity(name)) for name in entity_names)
+        for doc in self.docs.itervalues():
+            if doc['@id'] in entities:
+                entities[doc['@id']].add_document(deepcopy(doc), doc['@scope'])
+        return entities
+
+    def persist_entities(self, entities, chunk_size):
+        self.writes += 1
+        if self.writes == self.fail_at_write:
+            raise IOError("Connection lost")
+        results = []
+        for entity in entities:
+            for scope in ('public', 'private'):
+                document = entity.get_documents(scope)
+                if document is None:
+                    continue
+                doc = document.to_json()
+                doc.setdefault('_id', str(uuid.uuid4()))
+                stored = self.docs.get(doc['_id'])
+                if stored is not None and stored['_rev'] != doc.get('_rev'):
+                    results.append((entity.get_entity_name(), scope, False, doc['_id'], None))
+                    continue
+                doc['_rev'] = str(uuid.uuid4())
+                doc['@scope'] = scope
+                self.docs[doc['_id']] = deepcopy(doc)
+                results.append((entity.get_entity_name(), scope, True, doc['_id'], doc['_rev']))
+        return results
+
+    # ers-state
+    def get(self, doc_id):
+        return deepcopy(self.state.get(doc_id))
+
+    def save(self, doc):
+        doc['_rev'] = str(uuid.uuid4())
+        self.state[doc['_id']] = deepcopy(doc)
+
+    def delete(self, doc):
+        del self.state[doc['_id']]
+
+    def public_docs(self, entity_name):
+        return [doc for doc in self.docs.itervalues() if doc['@id'] == entity_name and doc['@scope'] == 'public']
+
+
+class ImportTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp(suffix='.nt')
+        with os.fdopen(fd, 'w') as f:
+            for i in range(50):
+                for j in range(3):
+                    f.write('<urn:ers:e{0}> <urn:ers:p{1}> "{0}-{1}" .\n'.format(i, j))
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def testGroupBySubject(self):
+        groups = list(group_by_subject(iter_nt(NT_DATA.splitlines())))
+        self.assertEqual(groups, [
+            ('urn:ers:a', [('urn:ers:p', 'one'), ('urn:ers:p', 'urn:ers:b')]),
+            ('urn:ers:b', [('urn:ers:q', 'two')]),
+            ('urn:ers:a', [('urn:ers:q', 'three')])])
+
+    def testTokenizer(self):
+        lines = [r'<urn:ers:a> <urn:ers:p> "say \"hi\"\n"@en-GB .',
+                 r'_:b1 <urn:ers:p> "42"^^<http://www.w3.org/2001/XMLSchema#integer> . # comment',
+                 r'<urn:ers:a> <urn:ers:p> _:b1 .',
+                 r'<urn:ers:a> <urn:ers:p> "caf\u00e9" .',
+                 '<urn:ers:caf\xc3\xa9> <urn:ers:p> "caf\xc3\xa9" .']
+        triples = list(tokenize_nt(lines))
+        self.assertEqual(triples, [
+            (u'urn:ers:a', u'urn:ers:p', u'say "hi"\n', None, u'en-GB'),
+            (u'_:b1', u'urn:ers:p', u'42', u'http://www.w3.org/2001/XMLSchema#integer', None),
+            (u'urn:ers:a', u'urn:ers:p', u'_:b1', None, None),
+            (u'urn:ers:a', u'urn:ers:p', u'caf\xe9', None, None),
+            (u'urn:ers:caf\xe9', u'urn:ers:p', u'caf\xe9', None, None)])
+        # Escaped or not, the same value is the same unicode string
+        self.assertTrue(all(isinstance(term, unicode) for triple in triples for term in triple if term is not None))
+        self.assertEqual(triples[3][2], triples[4][2])
+        self.assertRaises(NTriplesSyntaxError, list, tokenize_nt(['<urn:ers:a> <urn:ers:p> "\xff" .']))
+        self.assertRaises(NTriplesSyntaxError, list,
+                          tokenize_nt(['<urn:ers:a> <urn:ers:p> "x" .', '<urn:ers:a> <urn:ers:p> "unterminated .']))
+
+    def testLoadEntitiesInChunks(self):
+        registry = MemoryRegistry()
+        stats = load_entities(registry, group_by_subject(iter_nt(NT_DATA.splitlines())), chunk_size=2)
+        self.assertEqual(stats, {'entities': 2, 'statements': 4, 'batches': 2, 'failures': 0})
+        # The subject seen again is merged into its stored description
+        docs = registry.public_docs('urn:ers:a')
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['_id'], import_document_id(registry, 'urn:ers:a', 'public'))
+        self.assertEqual(docs[0]['urn:ers:p'], ['one', 'urn:ers:b'])
+        self.assertEqual(docs[0]['urn:ers:q'], 'three')
+
+        # Loading the same statements again changes nothing
+        stats = load_entities(registry, group_by_subject(iter_nt(NT_DATA.splitlines())), chunk_size=2)
+        self.assertEqual(stats['entities'], 0)
+        docs = registry.public_docs('urn:ers:a')
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['urn:ers:p'], ['one', 'urn:ers:b'])
+
+        # Entity.add itself appends, only the import treats values as a set
+        entity = Entity('urn:ers:a')
+        entity.add('urn:ers:p', 'one')
+        entity.add('urn:ers:p', 'one')
+        self.assertEqual(entity.get_documents('public').to_json()['urn:ers:p'], ['one', 'one'])
+
+    @patch('ers.utils.READ_BLOCK_SIZE', 256)
+    def testResumeImport(self):
+        registry = MemoryRegistry()
+        registry.fail_at_write = 4
+        self.assertRaises(IOError, import_nt, registry, self.file_name, chunk_size=5)
+        checkpoint = registry.state.values()[0]
+        self.assertEqual(checkpoint['batch'], 3)
+        self.assertTrue(checkpoint['offset'] > 0)
+
+        registry.fail_at_write = None
+        registry.writes = 0
+        stats = import_nt(registry, self.file_name, chunk_size=5)
+        self.assertTrue(registry.writes < 10)
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(registry.state, {})
+        for i in range(50):
+            docs = registry.public_docs('urn:ers:e{0}'.format(i))
+            self.assertEqual(len(docs), 1)
+            self.assertEqual(docs[0]['urn:ers:p2'], '{0}-2'.format(i))
+
+    def testParallelImport(self):
+        ranges = split_lines(self.file_name, 7)
+        with open(self.file_name) as f:
+            data = f.read()
+        self.assertEqual(''.join(data[start:end] for start, end in ranges), data)
+        self.assertTrue(all(data[start - 1] == '\n' for start, _ in ranges[1:]))
+
+        # The workers are forked with the patched class
+        registry = MemoryRegistry()
+        with patch('ers.utils.ERS', MemoryRegistry):
+            stats = import_nt_parallel(registry, self.file_name, processes=2, chunk_size=4)
+        self.assertEqual(stats['entities'], 50)
+        self.assertEqual(stats['statements'], 150)
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(registry.state, {})
+
+    def testReimportNonASCII(self):
+        path = tempfile.mkdtemp()
+        try:
+            registry = ERS(local_only=True, storage=store.STORAGE_SQLITE, storage_path=path)
+            lines = ['<urn:ers:caf\xc3\xa9> <urn:ers:p> "caf\xc3\xa9" .',
+                     r'<urn:ers:caf\u00e9> <urn:ers:p> "na\u00efve" .']
+            stats = load_entities(registry, group_by_subject(iter_nt(lines)))
+            self.assertEqual(stats['entities'], 1)
+            # Loading them again, as unicode or byte strings, changes nothing
+            stats = load_entities(registry, group_by_subject(iter_nt(lines)))
+            self.assertEqual(stats['entities'], 0)
+            load_entities(registry, [('urn:ers:caf\xc3\xa9', [('urn:ers:p', 'caf\xc3\xa9')])])
+            entity = registry.get_many([u'urn:ers:caf\xe9'], include_remote=False)[u'urn:ers:caf\xe9']
+            self.assertEqual(sorted(entity.to_tuples()),
+                             [(u'urn:ers:p', u'caf\xe9', 'public'), (u'urn:ers:p', u'na\xefve', 'public')])
+        finally:
+            shutil.rmtree(path)
+
+    def testWorkerStoreOptions(self):
+        registry = MemoryRegistry(storage=store.STORAGE_SQLITE, storage_path='/tmp/ers', stale='ok')
+        with patch('ers.utils.ERS', MemoryRegistry), patch.object(store, '_local_pool'):
+            utils._init_worker(registry.store_options)
+        self.assertEqual(utils._worker_registry.store_options,
+                         {'local_only': True, 'storage': store.STORAGE_SQLITE,
+                          'storage_path': '/tmp/ers', 'stale': 'ok'})
+
+
+class SQLiteStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = SQLiteDatabase(os.path.join(self.path, 'test.sqlite'), store.ERS_PUBLIC_DB)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testRevisionsAndConflicts(self):
+        doc = {'@id': TEST_ENTITY, 'rdf:type': 'ers:A'}
+        doc_id, rev = self.db.save(doc)
+        self.assertEqual((doc['_id'], doc['_rev']), (doc_id, rev))
+        self.assertTrue(rev.startswith('1-'))
+
+        stale = dict(doc)
+        doc['rdf:type'] = ['ers:A', 'ers:B']
+        self.assertTrue(self.db.save(doc)[1].startswith('2-'))
+        success, _, error = self.db.update([stale])[0]
+        self.assertFalse(success)
+        self.assertTrue(isinstance(error, store.http.ResourceConflict))
+        self.assertEqual(self.db[doc_id]['rdf:type'], ['ers:A', 'ers:B'])
+
+        self.assertTrue(self.db.delete_entity(TEST_ENTITY))
+        self.assertFalse(doc_id in self.db)
+        self.assertEqual(self.db.by_entity(TEST_ENTITY), [])
+        self.assertEqual([c['id'] for c in self.db.changes(since=2)['results']], [doc_id])
+
+    def testEntityAndPropertyIndexes(self):
+        self.db.update([{'@id': TEST_ENTITY + str(i), 'rdfs:label': [label, 'common']}
+                        for i, label in enumerate(['alpha', 'alpine', 'beta', 'alp*'])])
+        self.db.save({'@id': TEST_ENTITY + '0', 'rdf:type': 'ers:A'})
+
+        self.assertEqual(len(self.db.docs_by_entity(TEST_ENTITY + '0')), 2)
+        self.assertEqual(sorted(name for name, _ in self.db.docs_by_entities([TEST_ENTITY + '0', TEST_ENTITY + '1'])),
+                         [TEST_ENTITY + '0', TEST_ENTITY + '0', TEST_ENTITY + '1'])
+        self.assertTrue(self.db.entity_exist(TEST_ENTITY + '3'))
+        self.assertFalse(self.db.entity_exist(TEST_ENTITY + '4'))
+
+        self.assertEqual(sorted(self.db.by_property_value('rdfs:label', 'alp*')),
+                         [TEST_ENTITY + '0', TEST_ENTITY + '1', TEST_ENTITY + '3'])
+        self.assertEqual(self.db.by_property_value('rdfs:label', 'alp\\*'), [TEST_ENTITY + '3'])
+        self.assertEqual(self.db.by_property_value('rdfs:label', store.ValueRange('b', 'c')), [TEST_ENTITY + '2'])
+        self.assertEqual(self.db.count_by_property_value('rdfs:label'), 8)
+        self.assertEqual(self.db.facets_by_property('rdfs:label')['common'], 4)
+
+        names, cursor = self.db.page_by_property_value('rdfs:label', 'common', limit=3)
+        self.assertEqual(len(names), 3)
+        names += self.db.page_by_property_value('rdfs:label', 'common', limit=3, cursor=cursor)[0]
+        self.assertEqual(sorted(names), [TEST_ENTITY + str(i) for i in range(4)])
+
+    def testInvalidPages(self):
+        sqlite_store = SQLiteStore(self.path)
+        sqlite_store[store.ERS_PUBLIC_DB].save({'@id': TEST_ENTITY, 'rdf:type': 'ers:A'})
+        self.assertRaises(ValueError, sqlite_store.page_by_property_value, 'rdf:type', limit=0)
+        self.assertRaises(ValueError, sqlite_store.page_by_property_value, 'rdf:type', limit=-1)
+        for cursor in ['not a cursor', store.encode_cursor('ers-other', None),
+                       store.encode_cursor(store.ERS_PUBLIC_DB, 'position')]:
+            self.assertRaises(ValueError, sqlite_store.page_by_property_value, 'rdf:type', cursor=cursor)
+        names, cursor = sqlite_store.page_by_property_value('rdf:type', limit=1)
+        while cursor is not None:
+            page, cursor = sqlite_store.page_by_property_value('rdf:type', limit=1, cursor=cursor)
+            names.extend(page)
+        self.assertEqual(names, [TEST_ENTITY])
+
+    def testWriteBehindOnSQLite(self):
+        ers = ERS(local_only=True, storage=store.STORAGE_SQLITE, storage_path=self.path,
+                  write_behind=True, write_buffer_delay=60)
+        ers.store[store.ERS_CACHE_DB].save_replicas([{'_id': 'cached', '_rev': '1-a', '@id': TEST_ENTITY,
+                                                      'rdfs:label': 'cached'}])
+        entity = ers.get(TEST_ENTITY, include_remote=False)
+        entity.add('rdf:type', 'ers:A')
+        ers.persist_entity(entity)
+        # The buffered document is shown along with the cached one
+        self.assertEqual(sorted(ers.get(TEST_ENTITY, include_remote=False).to_tuples()),
+                         [('rdf:type', 'ers:A', 'public'), ('rdfs:label', 'cached', 'cache')])
+
+        entity = ers.get(TEST_ENTITY, include_remote=False)
+        entity.add('rdf:type', 'ers:B')
+        ers.persist_entities([entity])
+        # The older buffered copy is not written after it
+        self.assertEqual(ers.flush(), [])
+        self.assertEqual(sorted(ers.get(TEST_ENTITY, include_remote=False).to_tuples()),
+                         [('rdf:type', 'ers:A', 'public'), ('rdf:type', 'ers:B', 'public'),
+                          ('rdfs:label', 'cached', 'cache')])
+
+    def testReplicas(self):
+        doc = {'_id': 'doc1', '_rev': '2-b', '@id': TEST_ENTITY, 'rdf:type': 'ers:B'}
+        self.assertEqual(self.db.save_replicas([doc, dict(doc, _rev='1-a')]), 2)
+        self.assertEqual(self.db['doc1']['_rev'], '2-b')
+        self.assertEqual(self.db.save_replicas([doc]), 0)
+
+    def testNonASCII(self):
+        name, value = 'urn:ers:caf\xc3\xa9', 'caf\xc3\xa9 cr\xc3\xa8me'
+        doc_id, _ = self.db.save({'_id': 'caf\xc3\xa9', '@id': name, 'rdfs:label': value})
+        self.assertEqual(doc_id, u'caf\xe9')
+        self.assertEqual(self.db['caf\xc3\xa9']['rdfs:label'], u'caf\xe9 cr\xe8me')
+        self.assertEqual([key for key, doc in self.db.docs_by_entities([name])], [u'urn:ers:caf\xe9'])
+        self.assertEqual(self.db.by_property_value('rdfs:label', value), [u'urn:ers:caf\xe9'])
+        self.assertEqual(self.db.by_property_value('rdfs:label', 'caf\xc3\xa9*'), [u'urn:ers:caf\xe9'])
+        self.assertEqual(self.db.count_by_property_value('rdfs:label', value), 1)
+        self.assertEqual(self.db.facets_by_property('rdfs:label'), {u'caf\xe9 cr\xe8me': 1})
+
+        ers = ERS(local_only=True, storage=store.STORAGE_SQLITE, storage_path=self.path)
+        entity = ers.get(name)
+        entity.add('rdfs:label', value)
+        ers.persist_entity(entity)
+        self.assertEqual(ers.get_many([name])[u'urn:ers:caf\xe9'].to_tuples(),
+                         [(u'rdfs:label', u'caf\xe9 cr\xe8me', 'public')])
+        # rdflib terms are looked up and returned as unicode
+        entities = ers.get_many([URIRef(u'urn:ers:caf\xe9')], include_remote=False)
+        self.assertEqual(entities.keys(), [u'urn:ers:caf\xe9'])
+        self.assertEqual(type(entities.keys()[0]), unicode)
+        self.assertEqual(len(entities[u'urn:ers:caf\xe9'].to_tuples()), 1)
+        self.assertTrue(ers.delete_entity(name))
+        self.assertFalse(ers.entity_exist(name))
+
+    def testERSOnSQLite(self):
+        ers = ERS(local_only=True, storage=store.STORAGE_SQLITE, storage_path=self.path)
+        entity = ers.get(TEST_ENTITY)
+        entity.add('rdf:type', 'ers:TestCase')
+        entity.add('rdfs:label', 'private label', True)
+        ers.persist_entity(entity)
+
+        self.assertEqual(sorted(ers.get(TEST_ENTITY).to_tuples()),
+                         [('rdf:type', 'ers:TestCase', 'public'), ('rdfs:label', 'private label', 'private')])
+        self.assertEqual(ers.search('rdf:type', 'ers:TestCase'), [TEST_ENTITY])
+        self.assertEqual(ers.count('rdf:type'), 1)
+        ers.reset()
+        self.assertFalse(ers.entity_exist(TEST_ENTITY))
+
 
 if __name__ == '__main__':
     unittest.main()
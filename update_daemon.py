@@ -8,14 +8,10 @@ def main():
     while True:
         for prop in properties:
             entities_list = interface.search_for_entity(prop)
-            for entity_id in entities_list:
-                entity = interface.ers.get(entity_id)
-                interface.ers.cache_entity(entity)
+            interface.ers.cache_entities(interface.ers.get_many(entities_list).itervalues())
         for prop in prop_val:
             entities_list = interface.search_for_entity(prop, prop_val[prop])
-            for entity_id in entities_list:
-                entity = interface.ers.get(entity_id)
-                interface.ers.cache_entity(entity)
+            interface.ers.cache_entities(interface.ers.get_many(entities_list).itervalues())
 
     time.sleep(1)
 
@@ -2,7 +2,7 @@
     Web api that can be used to interact from the exterior with the ERS nodes.
     ! preserves state
 '''
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 app = Flask(__name__)
 import time
 import concurrent.futures
@@ -121,6 +121,10 @@ def list_peers():
     peers = interface.ers.get_peers()
     return str(peers)
 
+@app.route('/ShowPeerHealth')
+def show_peer_health():
+    return json.dumps(interface.ers.get_peer_health())
+
 
 @app.route('/ShowDB/<db_name>')
 def show_cache(db_name):
@@ -188,6 +192,38 @@ def search(prop, val):
     list_of_entities = interface.search_for_entity(prop, val)
     return str(list_of_entities)
 
+def _search_page(prop, value):
+    # ?limit= must be a positive integer and ?cursor= a token of a previous page
+    try:
+        limit = int(request.args.get('limit', 100))
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        list_of_entities, next_cursor = interface.ers.search_page(prop, value, limit,
+                                                                  request.args.get('cursor'))
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400
+    return json.dumps({'entities': list_of_entities, 'cursor': next_cursor})
+
+@app.route('/SearchPage/<prop>/')
+@app.route('/SearchPage/<prop>/<val>')
+def search_page(prop, val=None):
+    # Local results only, continue with ?cursor=<cursor of the previous page>
+    return _search_page(prop, val)
+
+@app.route('/SearchRange/<prop>/')
+def search_range(prop):
+    # Local results for ?start=&end= (either can be left out), paged like /SearchPage
+    value_range = store.ValueRange(request.args.get('start'), request.args.get('end'))
+    return _search_page(prop, value_range)
+
+@app.route('/StreamSearch/<prop>/')
+@app.route('/StreamSearch/<prop>/<val>')
+def stream_search(prop, val=None):
+    # One entity per line, sent as soon as the local store or a peer returns it
+    entities = interface.iter_search_for_entity(prop, val)
+    return Response(stream_with_context(entity + '\n' for entity in entities),
+                    mimetype='text/plain')
+
 if __name__ == '__main__':
     #app.debug = True
 